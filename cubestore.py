@@ -0,0 +1,171 @@
+import os
+import json
+import fcntl
+import shutil
+import weakref
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import utils
+from refresher import Forecast
+
+class CubeStore(object):
+    """
+    Versioned on-disk store of the decoded forecast, shared by all the
+    processes (e.g. gunicorn workers) of the same machine.
+    Every forecast basetime gets its own directory with the raw cube
+    (rr.npy), the time axis (time.npy) and the validators of the archive
+    (info.json). Processes map the cube read-only, so that the page cache
+    holds a single physical copy for everyone.
+    Every process holds a shared lock on the versions that it is using:
+    a version can be removed only when nobody holds it anymore.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def latest_version(self):
+        """
+        Name of the most recent published version, None if the store is empty.
+        """
+        try:
+            return (self.root/'LATEST').read_text().strip() or None
+        except IOError:
+            return None
+
+    def latest_info(self):
+        """
+        Validators and basetime of the most recent published version.
+        """
+        version = self.latest_version()
+        if version is None:
+            return {}
+        try:
+            with open(self.root/version/'info.json') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def publish(self, rr, time_radar, info):
+        """
+        Write a new version with the cube rr, the validity times (UTC)
+        of its steps and the validators info, then make it the latest one.
+        The version is written in a temporary directory which is then
+        renamed, so that readers never see a partially written cube.
+        """
+        version = info['basetime'].replace('-', '').replace(':', '')
+        target = self.root/version
+        tmp = self.root/('.{}.{}.tmp'.format(version, os.getpid()))
+        if not target.exists():
+            tmp.mkdir()
+            np.save(str(tmp/'rr.npy'), np.ascontiguousarray(rr))
+            np.save(str(tmp/'time.npy'), pd.to_datetime(time_radar).values)
+            with open(tmp/'info.json', 'w') as f:
+                json.dump(info, f)
+            (tmp/'lock').touch()
+            try:
+                os.rename(str(tmp), str(target))
+            except OSError:
+                # Someone else published the same version in the meantime
+                shutil.rmtree(str(tmp), ignore_errors=True)
+
+        latest_tmp = self.root/('.LATEST.{}.tmp'.format(os.getpid()))
+        latest_tmp.write_text(version)
+        os.replace(str(latest_tmp), str(self.root/'LATEST'))
+
+        return version
+
+    def open(self, version):
+        """
+        Map a version read-only and return it as a Forecast. The version
+        is protected from the cleanup until the returned cube is garbage
+        collected.
+        """
+        path = self.root/version
+        fd = os.open(str(path/'lock'), os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            rr = np.load(str(path/'rr.npy'), mmap_mode='r')
+            time_radar = np.load(str(path/'time.npy'))
+        except Exception:
+            os.close(fd)
+            raise
+        # Release the lock together with the mapping
+        weakref.finalize(rr, os.close, fd)
+
+        return Forecast(*utils.radar_coordinates(list(pd.to_datetime(time_radar))) + (rr,))
+
+    def open_latest(self):
+        """
+        Map the most recent published version, see open.
+        """
+        version = self.latest_version()
+        if version is None:
+            raise IOError("No forecast published in {}".format(self.root))
+
+        return self.open(version)
+
+    def update(self, url=None):
+        """
+        Download and publish the new forecast, if there is one. Only one
+        process at a time does the work: if another one is already updating
+        the store we return immediately. Returns True if a new version was published.
+        """
+        with self._exclusive(self.root/'update.lock') as acquired:
+            if not acquired:
+                return False
+            result = utils.fetch_radar_archive(self.latest_info(), url)
+            if result is None:
+                return False
+            self.publish(*result)
+
+        self.cleanup()
+
+        return True
+
+    def wait_update(self):
+        """
+        Wait until the process updating the store, if any, is done: e.g. while
+        the store is still empty and another process downloads the first forecast.
+        """
+        fd = os.open(str(self.root/'update.lock'), os.O_RDONLY | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+        finally:
+            os.close(fd)
+
+    def cleanup(self):
+        """
+        Remove the old versions that no process is using anymore.
+        """
+        latest = self.latest_version()
+        for path in self.root.iterdir():
+            if not path.is_dir() or path.name == latest or path.name.startswith('.'):
+                continue
+            with self._exclusive(path/'lock') as acquired:
+                if acquired:
+                    shutil.rmtree(str(path), ignore_errors=True)
+
+    @contextmanager
+    def _exclusive(self, lock_fn):
+        """
+        Try to get an exclusive lock on lock_fn without waiting,
+        yields whether the lock was acquired.
+        """
+        try:
+            fd = os.open(str(lock_fn), os.O_RDONLY | os.O_CREAT, 0o644)
+        except OSError:
+            yield False
+            return
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                yield False
+            else:
+                yield True
+        finally:
+            os.close(fd)
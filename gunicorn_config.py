@@ -0,0 +1,13 @@
+# Settings of gunicorn (see the Procfile), the other ones can still
+# be given on the command line or with GUNICORN_CMD_ARGS
+
+# Load the app in the master, so that the workers are forked from a process
+# which already imported and warmed up everything (see webapp.warm_up)
+preload_app = True
+
+def when_ready(server):
+    """
+    Called in the master once the app is loaded, before forking the workers.
+    """
+    import webapp
+    webapp.warm_up()
@@ -0,0 +1,52 @@
+import numpy as np
+from numba import jit, prange
+
+from utils import NODATA_CODE, RAIN_RATE_LUT
+
+# The compiled kernels of utils are kept here so that numba, which takes a while
+# to import, is only loaded by the functions that need it and not by every process
+# using utils (e.g. the workers of the webapp). The serial kernels are cached on
+# disk (in __pycache__, or in the user cache directory if that is not writable)
+# and compiled only once, not again in every new process.
+
+@jit(nopython=True, cache=True)
+def box_max(rr, steps, row0, row1, col0, col1):
+    """
+    Maximum code in every box, the missing data are skipped. Since the rain rate
+    increases with the code the maximum code gives the maximum rain rate.
+    """
+    codes = np.full(steps.shape, NODATA_CODE, dtype=np.uint8)
+    for i in range(steps.shape[0]):
+        for j in range(steps.shape[1]):
+            best = -1
+            for row in range(row0[j], row1[j]):
+                for col in range(col0[j], col1[j]):
+                    code = rr[steps[i, j], row, col]
+                    if code != NODATA_CODE and code > best:
+                        best = code
+            if best >= 0:
+                codes[i, j] = best
+
+    return codes
+
+# numba 0.41 cannot cache the kernels using the parallel target: this one is
+# compiled in every process when first used (never before forking, as
+# compiling it already starts the numba threads)
+@jit(nopython=True, parallel=True)
+def extract_rain_rate_batch(offsets, indx, indy, ind_time, rr, shifts, horizons):
+    """
+    Kernel of utils.extract_rain_rate_batch, every track is processed by a different thread.
+    Track k is covered by the forecast for the shifts below horizons[k].
+    """
+    rain_bike = np.full((len(shifts), len(ind_time)), np.nan)
+    for k in prange(len(offsets) - 1):
+        start, stop = offsets[k], offsets[k + 1]
+        if stop <= start:
+            continue
+        for i in range(len(shifts)):
+            if shifts[i] < 0 or shifts[i] >= horizons[k]:
+                continue
+            for j in range(start, stop):
+                rain_bike[i, j] = RAIN_RATE_LUT[rr[ind_time[j] + shifts[i], indx[j], indy[j]]]
+
+    return rain_bike
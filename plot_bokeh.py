@@ -1,16 +1,64 @@
-from bokeh.embed import file_html
+import json
+
+from bokeh.embed import json_item
 from bokeh.plotting import figure
 from bokeh.resources import CDN
-from bokeh.models import Band, ColumnDataSource
+from bokeh.models import Band, ColumnDataSource, Legend, LegendItem
 
 from flask import Markup
 import numpy as np 
-import pandas as pd 
+
+import utils
+
+# The page is always the same apart from the plot document, which is
+# embedded as json (see create_plot): the rest is rendered only once
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>Rain forecast for your ride</title>
+{resources}
+</head>
+<body>
+<div id="plot"></div>
+<script type="text/javascript">
+Bokeh.embed.embed_item({item}, "plot");
+</script>
+</body>
+</html>
+"""
+_page = None
+
+def page_shell():
+	"""
+	The html page around the plot, split in the parts before and after
+	the plot document. Built the first time that it's needed: concurrent
+	first requests may all build it, but they only assign the whole tuple,
+	so nobody ever sees a partial one.
+	"""
+	global _page
+	if _page is None:
+		page = PAGE_TEMPLATE.replace('{resources}', CDN.render_js() + CDN.render_css())
+		_page = tuple(page.split('{item}'))
+
+	return _page
 
 def create_plot(df):
-	plot = figure(plot_width=1000, plot_height=500)
+	"""
+	Html page with the plot of the forecast for every departure. Only
+	the plot document is serialized at every call (see plot_item).
+	"""
+	head, tail = page_shell()
+	# Escape the closing tags, the item ends up inside a <script>
+	item = json.dumps(plot_item(df)).replace('</', '<\\/')
+
+	return Markup(head + item + tail)
 
-	deltas_string = [delta.strftime('%H:%M') for delta in df.columns]
+def plot_item(df):
+	"""
+	The plot as a bokeh json item, which can be embedded with Bokeh.embed.embed_item.
+	"""
+	plot = figure(plot_width=1000, plot_height=500)
 
 	x = df.index.values.astype(float)/(60e9)
 	y = df.T.values
@@ -18,8 +66,9 @@ def create_plot(df):
 	colors = ('LightSteelBlue', 'SkyBlue', 'DodgerBlue',
 				 'RoyalBlue', 'DarkBlue', 'Navy', 'MidnightBlue')
 
-	sums_string     = ['%4.2f mm' % value for value in df.sum(axis=1)*(5./60.)]
-	labels        	= ['start '+m+', tot. '+n for m,n in zip(deltas_string, sums_string)]
+	# Total of every departure
+	sums_string     = np.char.mod('%4.2f mm', utils.total_rain(df))
+	labels        	= 'start ' + df.columns.strftime('%H:%M') + ', tot. ' + sums_string
 
 	plot.y_range.start = 0.
 	plot.y_range.end = y.max()
@@ -28,12 +77,20 @@ def create_plot(df):
 	plot.yaxis.axis_label = 'Precipitation [mm/h]'
 	plot.xaxis.axis_label = 'Time from departure [min]'
 
-	for i, ydata in enumerate(y):
-		plot.line(x, ydata, legend=labels[i], color=colors[i], line_width=3)
-
-	plot.legend.label_text_font_size = '8pt'
-	plot.legend.location = "top_left"
-	plot.legend.click_policy="hide"
+	# The legend is built at once, adding every line to it with legend=
+	# would search the whole plot every time
+	# All the lines share the same source, so that x is sent only once,
+	# and float32 is more than enough for the browser
+	data = {'y{}'.format(i): ydata.astype(np.float32) for i, ydata in enumerate(y)}
+	data['x'] = x.astype(np.float32)
+	source = ColumnDataSource(data=data)
+	# Steps, as every value holds until the next point (see utils.compact_track)
+	items = [LegendItem(label=labels[i],
+						renderers=[plot.step('x', 'y{}'.format(i), source=source, mode='after',
+											 color=colors[i % len(colors)], line_width=3)])
+			 for i in range(len(y))]
+	plot.add_layout(Legend(items=items, label_text_font_size='8pt',
+						   location="top_left", click_policy="hide"))
 	plot.title.text = 'Click on legend entries to hide the corresponding lines'
 
 	# Bands
@@ -41,13 +98,12 @@ def create_plot(df):
 	band2 = add_band(x, y, 2.5, 7.6, plot, alpha=0.3)
 	band2 = add_band(x, y, 7.6, y.max(), plot, alpha=0.5)
 
-	return Markup(file_html(plot, CDN, "Rain forecast for your ride"))
+	return json_item(plot)
 
 def add_band(x,y, minimum, maximum, plot, alpha, color='lightsteelblue'):
-	dftemp = pd.DataFrame(data=dict(x=x, y=y[0])).sort_values(by="x")
-	dftemp['upper'] = minimum
-	dftemp['lower'] = maximum 
-	source = ColumnDataSource(dftemp.reset_index())
+	# The bands are constant, the first and last point are enough
+	x_ends = [float(x.min()), float(x.max())]
+	source = ColumnDataSource(data=dict(x=x_ends, lower=[minimum]*2, upper=[maximum]*2))
 
 	band = Band(base='x', lower='lower', upper='upper', source=source, level='underlay',
             	fill_alpha=alpha, line_width=0.3, line_color='black', fill_color=color, line_dash='dashed')
@@ -1,43 +1,128 @@
+import threading
+
 import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.legend import Legend
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-def make_plot(df, out_filename=None):
-    import matplotlib
-    matplotlib.use("Agg")
-
-    import matplotlib.pyplot as plt
-    fig = plt.figure(figsize=(12,5))
-    ax = plt.gca()
-
-    # Create the labels including the original datetime and a sum of the rain
-    deltas_string   = [delta.strftime('%H:%M') for delta in df.columns]
-    sums_string     = ['%4.2f mm' % value for value in df.sum(axis=1)*(5./60.)]
-    labels          = ['start '+m+', tot. '+n for m,n in zip(deltas_string, sums_string)]
-    # Since timedelta objects are not correctly handled by matplotlib
-    # we need to do this converstion manually
-    x = df.index.values.astype(float)/(60e9)
-
-    ax.plot(x, df.values, '-')
-    ax.spines['right'].set_visible(False)
-    ax.spines['top'].set_visible(False)
-    ax.xaxis.grid(True, ls='dashed')
-    #ax.set_title("Radar forecast | Basetime "+time_radar[0].strftime("%Y%m%d %H:%M"))
-    ax.set_ylabel("$P$ [mm h$^{-1}$]")
-    ax.set_xlabel("Time from start [minutes]")
-    ax.fill_between(x, y1=0, y2=2.5, alpha=0.4, color="paleturquoise")
-    ax.fill_between(x, y1=2.5, y2=7.6, alpha=0.3, color="lightseagreen")
-    ax.fill_between(x, y1=7.6, y2=ax.get_ylim()[-1], alpha=0.3, color="teal")
-    ax.set_xlim(left=x[0], right=x[-1])
-    ax.set_ylim(bottom=0, top=df.values.max())
-    if df.values.max() > 0.5:
-        ax.annotate("Light", xy=(x[-20], .1), alpha=0.6)
-    if df.values.max() > 3.0 :
-        ax.annotate("Moderate", xy=(x[-20], 2.6), alpha=0.6)
-    if df.values.max() > 8.0 :
-        ax.annotate("Heavy", xy=(x[-20], 7.7), alpha=0.5)
-    plt.legend(labels, fontsize=7)
+import utils
+
+class PlotRenderer(object):
+    """
+    Draw the forecast for every departure on a figure which is built only
+    once and then reused: the lines, the bands and the annotations are
+    updated in place at every render. pyplot is not used at all, so nothing
+    is kept in its global state and figures never pile up.
+    A renderer must not be used by two threads at the same time, see get_renderer.
+    """
+    def __init__(self):
+        self.fig = Figure(figsize=(12,5))
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = ax = self.fig.add_subplot(111)
+
+        ax.spines['right'].set_visible(False)
+        ax.spines['top'].set_visible(False)
+        ax.xaxis.grid(True, ls='dashed')
+        #ax.set_title("Radar forecast | Basetime "+time_radar[0].strftime("%Y%m%d %H:%M"))
+        ax.set_ylabel("$P$ [mm h$^{-1}$]")
+        ax.set_xlabel("Time from start [minutes]")
+        # The bands always cover the whole x axis, only the top of the last one changes
+        ax.axhspan(0, 2.5, alpha=0.4, color="paleturquoise")
+        ax.axhspan(2.5, 7.6, alpha=0.3, color="lightseagreen")
+        self.heavy_band = ax.axhspan(7.6, 7.6, alpha=0.3, color="teal")
+        # Annotations shown above their lower limit: (maximum, artist)
+        self.annotations = [(0.5, ax.text(0, .1, "Light", alpha=0.6, visible=False)),
+                            (3.0, ax.text(0, 2.6, "Moderate", alpha=0.6, visible=False)),
+                            (8.0, ax.text(0, 7.7, "Heavy", alpha=0.5, visible=False))]
+        self.lines = []
+        self.legends = {}
+        self.legend = None
+
+    def draw(self, df):
+        """
+        Update the figure with the forecast in df (see utils.convert_to_dataframe).
+        """
+        ax = self.ax
+        # Since timedelta objects are not correctly handled by matplotlib
+        # we need to do this converstion manually
+        x = df.index.values.astype('timedelta64[ns]').astype(float)/(60e9)
+        y = df.values.T
+        y_max = y.max()
+
+        # Reuse the lines of the previous renders and only hide the ones not needed:
+        # in matplotlib 3.0 every line attached to the axes leaves an entry in
+        # the units callbacks of the axis when removed, so they're never removed
+        for ydata, line in zip(y, self.lines):
+            line.set_data(x, ydata)
+            line.set_visible(True)
+        for i in range(len(self.lines), len(y)):
+            # The same colors as a new figure, whatever happened before, and steps
+            # as every value holds until the next point (see utils.compact_track)
+            self.lines.append(ax.plot(x, y[i], '-', drawstyle='steps-post',
+                                      color='C{}'.format(i % 10))[0])
+        for line in self.lines[len(y):]:
+            line.set_visible(False)
+
+        # Create the labels including the original datetime and the total rain of every departure
+        sums_string     = np.char.mod('%4.2f mm', utils.total_rain(df))
+        labels          = 'start ' + df.columns.strftime('%H:%M') + ', tot. ' + sums_string
+        # For the same reason there's one legend for every number of lines,
+        # whose labels are updated, and only the one needed is on the axes
+        legend = self.legends.get(len(y))
+        if legend is None:
+            legend = self.legends[len(y)] = Legend(ax, self.lines[:len(y)], labels, fontsize=7)
+        else:
+            for text, label in zip(legend.get_texts(), labels):
+                text.set_text(label)
+        if legend is not self.legend:
+            if self.legend is not None:
+                self.legend.remove()
+            self.legend = ax.add_artist(legend)
 
+        self.heavy_band.set_xy([[0, 7.6], [0, max(y_max, 7.6)], [1, max(y_max, 7.6)], [1, 7.6]])
+        ax.set_xlim(left=x[0], right=x[-1])
+        ax.set_ylim(bottom=0, top=y_max)
+        # The compacted track may have less than 20 points
+        x_label = x[-min(20, len(x))]
+        for maximum, annotation in self.annotations:
+            annotation.set_x(x_label)
+            annotation.set_visible(y_max > maximum)
+
+        return self.fig
+
+    def render(self, df, out_filename, format='png'):
+        """
+        Draw df and save it in out_filename, which can also be a
+        file-like object (e.g. io.BytesIO) to render it in memory.
+        """
+        self.draw(df)
+        self.fig.savefig(out_filename, format=format)
+
+# One renderer for every thread of the process
+_renderers = threading.local()
+
+def get_renderer():
+    """
+    The renderer of the current thread, created the first time it's needed.
+    """
+    renderer = getattr(_renderers, 'renderer', None)
+    if renderer is None:
+        renderer = _renderers.renderer = PlotRenderer()
+
+    return renderer
+
+def make_plot(df, out_filename=None):
+    """
+    Plot the forecast for every departure with the renderer of this thread
+    and save it in out_filename, if given (a file name or a file-like object).
+    The returned figure is reused by the next plot of the same thread.
+    """
+    renderer = get_renderer()
     if out_filename:
-        plt.savefig(out_filename)
-        print("Wrote plot to `{}`".format(out_filename))
+        renderer.render(df, out_filename)
+        if isinstance(out_filename, str):
+            print("Wrote plot to `{}`".format(out_filename))
+    else:
+        renderer.draw(df)
 
-    return fig
\ No newline at end of file
+    return renderer.fig
@@ -4,8 +4,13 @@ import numpy as np
 import sys
 import utils
 import radolan as radar
+from refresher import Forecast
+from trackcache import TrackCache
+from routecache import RouteCache
 
 from pathlib import Path
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, Future
 
 # Folder to download the data (they will be removed 
 # but it needs some space to start with)
@@ -14,26 +19,90 @@ data_path.mkdir(exist_ok=True)
 
 json = False
 
-def main(track_file=None, start_point=None, end_point=None, mode=None):
+def main(track_file=None, start_point=None, end_point=None, mode=None, forecast=None,
+         shifts=utils.shifts, per_point=False, track_cache=None,
+         route_cache=None, track_filename=None, result_cache=None, track_key=None):
     """
-    Download and process the data. 
+    Download and process the data. If an already decoded forecast
+    (see refresher.Forecast) is passed it is used instead of 
+    retrieving the radar data. forecast can also be a function returning
+    it (e.g. refresher.ForecastRefresher.current): the forecast is then
+    retrieved in another thread while the track is read, and so is the
+    radar data when no forecast is given. shifts are the departure offsets (in
+    units of 5 minutes) to evaluate, None for every possible one.
+    The forecast is computed on the compacted track (see utils.compact_track)
+    and only expanded to every point of the track if per_point is True.
+    track_file can also be a file-like object, e.g. an upload which doesn't
+    need to be saved, and then track_filename gives its format (see utils.read_input).
+    Uploaded tracks are read through track_cache (see trackcache.TrackCache)
+    and itineraries through route_cache (see routecache.RouteCache), if given.
+    track_key is the key of track_file (see trackcache.TrackCache.key), if the
+    caller already has it: the file is hashed at most once in any case.
+    If a resultcache.ResultCache is given the whole result is reused when the
+    same track, with the same options, was already computed on this forecast.
     """
     if not debug:
-        if track_file:
-            lon_bike,  lat_bike,  dtime_bike = utils.read_input(track_file)
+        if forecast is None:
+            forecast = partial(utils.get_radar_data, data_path)
 
-        elif (start_point and end_point):
-            lon_bike,  lat_bike,  dtime_bike = utils.gmaps_parser(start_point=start_point, end_point=end_point, mode=mode)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            if callable(forecast):
+                forecast = executor.submit(forecast)
 
-        lon_radar, lat_radar, time_radar, dtime_radar, rr = utils.get_radar_data(data_path)
-        
-        rain_bike = utils.extract_rain_rate_from_radar(lon_bike=lon_bike, lat_bike=lat_bike,
-                        dtime_bike=dtime_bike.values.astype("int"),
-                        dtime_radar=dtime_radar.values.astype("int"),
-                        lat_radar=lat_radar,
-                        lon_radar=lon_radar, rr=rr)
+            # The key is computed before reading the track, as an upload cannot
+            # be read by two threads at the same time, and only once for both caches
+            if track_file and track_key is None and (track_cache is not None or result_cache is not None):
+                track_key = TrackCache.key(track_file, track_filename)
+            if result_cache is not None:
+                if track_file:
+                    track = track_key
+                else:
+                    track = RouteCache.key(start_point, end_point, mode)
+                key = result_cache.key(track, shifts, per_point)
 
-        df = utils.convert_to_dataframe(rain_bike, dtime_bike, time_radar)
+            # The track is read (or the itinerary requested) while the forecast is retrieved...
+            if track_file:
+                reader = executor.submit(utils.read_input, track_file, cache=track_cache,
+                                         filename=track_filename, key=track_key)
+
+            elif (start_point and end_point):
+                reader = executor.submit(utils.gmaps_parser, start_point=start_point, end_point=end_point,
+                                         mode=mode, cache=route_cache)
+
+            if isinstance(forecast, Future):
+                forecast = forecast.result()
+            # utils.get_radar_data (and whoever calls main) may give a plain tuple
+            forecast = Forecast(*forecast)
+
+            df = None
+            if result_cache is not None:
+                # ...but it's not needed if the result is already there
+                df = result_cache.get(key, forecast.time_radar[0])
+            if df is None:
+                lon_bike,  lat_bike,  dtime_bike = reader.result()
+            else:
+                reader.cancel()
+
+        if df is None:
+            lon_radar, lat_radar, time_radar, dtime_radar, rr = forecast
+
+            lon_run, lat_run, dtime_run, counts = utils.compact_track(lon_bike, lat_bike, dtime_bike,
+                            lon_radar, lat_radar, dtime_radar, rr.shape[1:])
+            
+            rain_bike = utils.extract_rain_rate_from_radar(lon_bike=lon_run, lat_bike=lat_run,
+                            dtime_bike=dtime_run.values.astype("timedelta64[ns]").astype("int"),
+                            dtime_radar=dtime_radar.values.astype("timedelta64[ns]").astype("int"),
+                            lat_radar=lat_radar,
+                            lon_radar=lon_radar, rr=rr, shifts=shifts)
+
+            if per_point:
+                rain_bike = utils.expand_track(rain_bike, counts)
+            else:
+                dtime_bike = dtime_run
+
+            df = utils.convert_to_dataframe(rain_bike, dtime_bike, time_radar, shifts=shifts)
+            if result_cache is not None:
+                result_cache.put(key, time_radar[0], df)
     else:
         df = utils.create_dummy_dataframe()
 
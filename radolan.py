@@ -29,6 +29,7 @@ except ImportError:
     import io
 
 import re
+import bisect
 import warnings
 
 # site packages
@@ -38,6 +39,10 @@ import numpy as np
 # raa00-dx_10488-200608050000-drs---bin
 dwdpattern = re.compile('raa..-(..)[_-]([0-9]{5})-([0-9]*)-(.*?)---bin')
 
+# the ASCII header is read in blocks of this size (in bytes) until the
+# end of header character is found, usual headers fit in one block
+HEADER_BLOCK_SIZE = 1024
+
 def _get_timestamp_from_filename(filename):
     """Helper function doing the actual work of get_dx_timestamp"""
     time = dwdpattern.search(filename).group(3)
@@ -78,19 +83,16 @@ def get_radolan_header_token_pos(header):
         d = header.rfind(token)
         if d > -1:
             head_dict[token] = d
-    head = {}
 
-    result_dict = {}
-    result_dict.update((k, v) for k, v in head_dict.items() if v is not None)
+    # every field ends where the next token starts
+    positions = sorted(v for v in head_dict.values() if v is not None)
+    positions.append(len(header))
+
+    head = {}
     for k, v in head_dict.items():
         if v is not None:
-            start = v + len(k)
-            filt = [x for x in result_dict.values() if x > v]
-            if filt:
-                stop = min(filt)
-            else:
-                stop = len(header)
-            head[k] = (start, stop)
+            stop = positions[bisect.bisect_right(positions, v)]
+            head[k] = (v + len(k), stop)
         else:
             head[k] = v
 
@@ -182,7 +184,7 @@ def parse_dwd_composite_header(header):
     return out
 
 
-def decode_radolan_runlength_line(line, attrs):
+def decode_radolan_runlength_line(line, attrs, out=None):
     """Decodes one line of runlength coded binary data of DWD
     composite file and returns decoded array
     Parameters
@@ -191,51 +193,60 @@ def decode_radolan_runlength_line(line, attrs):
         of byte values
     attrs : dict
         dictionary of attributes derived from file header
+    out : :func:`numpy:numpy.array`
+        optional array of length ncol where the decoded values are written
     Returns
     -------
     arr : :func:`numpy:numpy.array`
         of decoded values
     """
+    nodata = attrs['nodataflag']
+    if out is None:
+        out = np.empty(attrs['ncol'], dtype=_get_runlength_dtype(nodata))
+
     # byte '0' is line number, we don't need it
     # so we start with offset byte,
     lo = 1
     byte = line[lo]
     # line empty condition, lf directly behind line number
     if byte == 10:
-        return np.ones(attrs['ncol'], dtype=np.uint8) * attrs['nodataflag']
-    offset = byte - 16
+        out[:] = nodata
+        return out
+    offset = int(byte) - 16
 
     # check if offset byte is 255 and take next byte(s)
     # also for the offset
     while byte == 255:
         lo += 1
         byte = line[lo]
-        offset += byte - 16
+        offset += int(byte) - 16
 
-    # just take the rest
+    # just take the rest, until lf (10) is reached
     dline = line[lo + 1:]
+    lf = np.flatnonzero(dline == 10)
+    runs = dline[:lf[0]] if lf.size else dline
+
+    # every byte is a run: width in the high nibble, value in the low one
+    decoded = np.repeat(runs & 0x0F, runs >> 4)
+    # the "offset pixel" are "not measured" values
+    # so we set them to 'nodata', as well as the trailing ones
+    stop = offset + decoded.size
+    trailing = attrs['ncol'] - stop
+    if trailing < 0:
+        out[:] = dline[:trailing]
+        return out
+    out[:offset] = nodata
+    out[offset:stop] = decoded
+    out[stop:] = nodata
 
-    # this could be optimized
-    # iterate over line string, until lf (10) is reached
-    for lo, byte in enumerate(dline):
-        if byte == 10:
-            break
-        width = (byte & 0xF0) >> 4
-        val = byte & 0x0F
-        # the "offset pixel" are "not measured" values
-        # so we set them to 'nodata'
-        if lo == 0:
-            arr = np.ones(offset, dtype=np.uint8) * attrs['nodataflag']
-        arr = np.append(arr, np.ones(width, dtype=np.uint8) * val)
-
-    trailing = attrs['ncol'] - len(arr)
-    if trailing > 0:
-        arr = np.append(arr, np.ones(trailing,
-                                     dtype=np.uint8) * attrs['nodataflag'])
-    elif trailing < 0:
-        arr = dline[:trailing]
+    return out
 
-    return arr
+
+def _get_runlength_dtype(nodata):
+    """Returns the dtype of the decoded runlength values, that is the
+    smallest type holding both the 4 bit values and the nodata flag
+    """
+    return np.promote_types(np.uint8, np.min_scalar_type(nodata))
 
 
 def read_radolan_runlength_line(fid):
@@ -277,20 +288,27 @@ def decode_radolan_runlength_array(binarr, attrs):
         of decoded values
     """
     buf = io.BytesIO(binarr)
+    nrow = attrs['nrow']
+    arr = np.empty((nrow, attrs['ncol']),
+                   dtype=_get_runlength_dtype(attrs['nodataflag']))
 
-    # read and decode first line
-    line = read_radolan_runlength_line(buf)
-    arr = decode_radolan_runlength_line(line, attrs)
-
-    # read following lines
+    # lines are written directly in their row, starting from the
+    # last one because first line read is top line
+    row = nrow - 1
     line = read_radolan_runlength_line(buf)
-
     while line is not None:
-        dline = decode_radolan_runlength_line(line, attrs)
-        arr = np.vstack((arr, dline))
+        if row < 0:
+            raise ValueError('More than {0} lines of runlength coded '
+                             'data'.format(nrow))
+        decode_radolan_runlength_line(line, attrs, out=arr[row])
+        row -= 1
         line = read_radolan_runlength_line(buf)
-    # return upside down because first line read is top line
-    return np.flipud(arr)
+
+    if row >= 0:
+        raise ValueError('Only {0} of {1} lines of runlength coded '
+                         'data'.format(nrow - row - 1, nrow))
+
+    return arr
 
 
 def read_radolan_binary_array(fid, size):
@@ -348,16 +366,22 @@ def read_radolan_header(fid):
     # rewind, just in case...
     fid.seek(0, 0)
 
-    header = ''
+    header = b''
     while True:
-        mychar = fid.read(1)
-        if not mychar:
+        block = fid.read(HEADER_BLOCK_SIZE)
+        if not block:
             raise EOFError('Unexpected EOF detected while reading '
                            'RADOLAN header')
-        if mychar == b'\x03':
+        end = block.find(b'\x03')
+        if end > -1:
+            header += block[:end]
             break
-        header += str(mychar.decode())
-    return header
+        header += block
+
+    # leave the file handle at the start of the data section
+    fid.seek(len(header) + 1, 0)
+
+    return header.decode()
 
 
 def read_radolan_composite(f, missing=-9999, loaddata=True):
@@ -499,13 +523,92 @@ def z_to_r(z, a=200., b=1.6):
     """
     return (z / a) ** (1. / b)
 
-def get_latlon_radar(file='radolan_grid.pickle'):
-    import pickle
-    '''Get the lat/lon coordinates of RADOLAN from a file
-    so that we don't need to recreate them every time.
-    We need to evaluate whether pickle is the fastest choice.
+# Parameters of the polar stereographic projection of the RADOLAN grid,
+# on a spherical earth (see the RADOLAN/RADVOR format description)
+RADOLAN_EARTH_RADIUS = 6370.04  # km
+RADOLAN_LAMBDA0 = 10.  # reference longitude
+RADOLAN_PHI0 = 60.  # latitude where the projection is true to scale
+# Projected coordinates (km) of the lower left corner of the grids
+RADOLAN_GRID_ORIGIN = {(900, 900): (-523.4622, -4658.645),
+                       (1100, 900): (-443.4622, -4758.645)}
+
+# Lat/lon grids already computed in this process
+_latlon_grids = {}
+
+
+def get_radolan_xy_from_lonlat(lon, lat):
+    """Projects geographical coordinates to the RADOLAN polar
+    stereographic coordinates
+    Parameters
+    ----------
+    lon, lat : float or :func:`numpy:numpy.array`
+        longitude and latitude in degrees
+    Returns
+    -------
+    x, y : float or :func:`numpy:numpy.array`
+        projected coordinates in km
+    """
+    lam = np.radians(lon)
+    phi = np.radians(lat)
+    scale = ((1. + np.sin(np.radians(RADOLAN_PHI0))) / (1. + np.sin(phi)) *
+             RADOLAN_EARTH_RADIUS * np.cos(phi))
+    dlam = lam - np.radians(RADOLAN_LAMBDA0)
+
+    return scale * np.sin(dlam), -scale * np.cos(dlam)
+
+
+def get_radolan_lonlat_from_xy(x, y):
+    """Inverse of :func:`get_radolan_xy_from_lonlat`
+    Parameters
+    ----------
+    x, y : float or :func:`numpy:numpy.array`
+        projected coordinates in km
+    Returns
+    -------
+    lon, lat : float or :func:`numpy:numpy.array`
+        longitude and latitude in degrees
+    """
+    r2 = (RADOLAN_EARTH_RADIUS *
+          (1. + np.sin(np.radians(RADOLAN_PHI0)))) ** 2
+    d2 = x ** 2 + y ** 2
+    lon = np.degrees(np.arctan(-x / y)) + RADOLAN_LAMBDA0
+    lat = np.degrees(np.arcsin((r2 - d2) / (r2 + d2)))
+
+    return lon, lat
+
+
+def get_radolan_rowcol(lon, lat, nrow=900, ncol=900):
+    """Indices of the RADOLAN grid points closest to the given
+    geographical coordinates, points outside of the grid get the
+    indices of the closest border
+    Parameters
+    ----------
+    lon, lat : float or :func:`numpy:numpy.array`
+        longitude and latitude in degrees
+    nrow, ncol : int
+        dimensions of the RADOLAN grid
+    Returns
+    -------
+    row, col : :func:`numpy:numpy.array`
+        grid indices, row 0 is the southernmost one
+    """
+    x0, y0 = RADOLAN_GRID_ORIGIN[(nrow, ncol)]
+    x, y = get_radolan_xy_from_lonlat(lon, lat)
+    # the grid spacing is 1 km
+    row = np.clip(np.rint(y - y0), 0, nrow - 1).astype(np.int64)
+    col = np.clip(np.rint(x - x0), 0, ncol - 1).astype(np.int64)
+
+    return row, col
+
+
+def get_latlon_radar(nrow=900, ncol=900):
+    '''Get the lat/lon coordinates of the RADOLAN grid. They're computed
+    with the polar stereographic projection only the first time they're
+    needed and then kept, so that we don't need to recreate them every time.
     Returns, in order, lon and lat 2-d arrays.'''
-    with open(file, 'rb') as handle:
-        radolan_grid_ll = pickle.load(handle)
+    if (nrow, ncol) not in _latlon_grids:
+        x0, y0 = RADOLAN_GRID_ORIGIN[(nrow, ncol)]
+        x, y = np.meshgrid(x0 + np.arange(ncol), y0 + np.arange(nrow))
+        _latlon_grids[(nrow, ncol)] = get_radolan_lonlat_from_xy(x, y)
 
-    return(radolan_grid_ll[:,:,0],radolan_grid_ll[:,:,1])
\ No newline at end of file
+    return _latlon_grids[(nrow, ncol)]
@@ -0,0 +1,134 @@
+import os
+import time
+import threading
+import traceback
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import utils
+
+# The decoded forecast, as returned by utils.get_radar_data. Once published
+# a forecast is never modified, so requests can keep using it while the
+# next one is built.
+Forecast = namedtuple('Forecast', ['lon_radar', 'lat_radar', 'time_radar',
+                                   'dtime_radar', 'rr'])
+
+# DWD needs some time after the basetime to publish the new forecast,
+# so we wait a bit after the start of every 5 minutes cycle...
+PUBLICATION_DELAY = timedelta(minutes=1)
+# ...and we retry every RETRY_INTERVAL seconds until we get it
+# (or if something went wrong with the download)
+RETRY_INTERVAL = 30
+# Seconds that a request waits for the first forecast before giving up,
+# below the 30 seconds after which gunicorn kills a silent worker
+TIMEOUT = 20
+
+class ForecastUnavailable(RuntimeError):
+    """
+    No forecast was published within the timeout, see ForecastRefresher.current.
+    """
+
+class ForecastRefresher(object):
+    """
+    Keep the latest forecast decoded in memory. A background thread follows
+    the 5 minutes cycle of the DWD forecast, builds the new cube and its
+    time axis off the request path and then publishes it by swapping a
+    single reference, so that requests always see a complete forecast
+    and the ones already running keep the previous version until they finish.
+    If a cubestore.CubeStore is given the forecast is downloaded only by one
+    process and then shared, memory-mapped, by all of them.
+    """
+    def __init__(self, data_path, stream=True, store=None, retry_interval=RETRY_INTERVAL,
+                 timeout=TIMEOUT):
+        self.data_path = data_path
+        self.stream = stream
+        self.store = store
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self._forecast = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """
+        Start the background thread, if not already running in this process.
+        Threads do not survive a fork, so it is restarted in every worker.
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run,
+                                            name='forecast-refresher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def current(self, timeout=None):
+        """
+        Return the currently published forecast, waiting for the first one
+        to be ready if needed: at most timeout seconds (by default the one
+        of the refresher), then ForecastUnavailable is raised.
+        """
+        self.start()
+        if not self._ready.wait(self.timeout if timeout is None else timeout):
+            raise ForecastUnavailable("No radar forecast available yet")
+
+        return self._forecast
+
+    def refresh(self):
+        """
+        Get the latest forecast and publish it. Returns True if the forecast
+        changed with respect to the published one.
+        """
+        if self.store is not None:
+            try:
+                self.store.update()
+            except Exception:
+                # The server may be down, but a forecast may already be
+                # in the store (e.g. published before this worker was forked)
+                traceback.print_exc()
+            if self.store.latest_version() is None:
+                # Another process may be downloading the first forecast,
+                # which is much sooner than the next retry
+                self.store.wait_update()
+            forecast = self.store.open_latest()
+        else:
+            forecast = Forecast(*utils.get_radar_data(self.data_path, stream=self.stream))
+            forecast.rr.flags.writeable = False
+
+        previous = self._forecast
+        if previous is not None and previous.time_radar[0] == forecast.time_radar[0]:
+            return False
+
+        # Publishing is a single reference assignment: atomic for the readers
+        self._forecast = forecast
+        self._ready.set()
+
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                changed = self.refresh()
+            except Exception:
+                # Keep serving the published forecast (if any) and try again
+                traceback.print_exc()
+                changed = False
+            if changed:
+                time.sleep(seconds_to_next_cycle())
+            else:
+                time.sleep(self.retry_interval)
+
+def seconds_to_next_cycle(now=None):
+    """
+    Seconds until the next forecast is expected on the server, that is
+    the start of the next 5 minutes cycle plus the publication delay.
+    """
+    if now is None:
+        now = datetime.utcnow()
+    cycle = utils.FORECAST_CYCLE.total_seconds()
+    elapsed = (now - datetime(now.year, now.month, now.day)).total_seconds() % cycle
+
+    return cycle - elapsed + PUBLICATION_DELAY.total_seconds()
@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict
+
+# Memory used by the cached results, the least recently used are removed above it
+MAX_BYTES = 32 * 1024 * 1024
+
+class ResultCache(object):
+    """
+    In-memory cache of the forecast along the tracks (the dataframes returned
+    by radar_forecast_bike.main), so that the same track asked again during
+    the same forecast cycle is not parsed nor extracted again.
+    Results are kept per forecast basetime: as soon as a newer basetime is
+    seen all the results of the previous forecast are dropped. When they use
+    more than max_bytes the least recently used results are removed.
+    The cached dataframes are shared, they must not be modified.
+    hits, misses and evictions count what happened since the start, see stats.
+    """
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._results = OrderedDict()
+        self._size = 0
+        self._basetime = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(track, shifts, per_point):
+        """
+        Key of a result: the key of the track (e.g. trackcache.TrackCache.key or
+        routecache.RouteCache.key) and the options of radar_forecast_bike.main.
+        """
+        return (track, None if shifts is None else tuple(shifts), per_point)
+
+    def get(self, key, basetime):
+        """
+        Return the result for key computed with the forecast of basetime,
+        None if there is none.
+        """
+        with self._lock:
+            if not self._use(basetime) or key not in self._results:
+                self.misses += 1
+                return None
+            self._results.move_to_end(key)
+            self.hits += 1
+
+            return self._results[key][0]
+
+    def put(self, key, basetime, df):
+        """
+        Store the result for key computed with the forecast of basetime.
+        """
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            if not self._use(basetime) or size > self.max_bytes:
+                return
+            if key in self._results:
+                self._size -= self._results.pop(key)[1]
+            self._results[key] = (df, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, removed) = self._results.popitem(last=False)
+                self._size -= removed
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._size = 0
+
+    def stats(self):
+        """
+        Counters and size of the cache, to tune max_bytes.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(self._results),
+                    'bytes': self._size, 'max_bytes': self.max_bytes,
+                    'basetime': None if self._basetime is None else str(self._basetime)}
+
+    def _use(self, basetime):
+        """
+        Whether results of basetime can be used, dropping the ones of an older
+        forecast if needed. Requests still running on an older forecast
+        than the cached one are not cached.
+        """
+        if self._basetime is None or basetime > self._basetime:
+            self._results.clear()
+            self._size = 0
+            self._basetime = basetime
+
+        return basetime == self._basetime
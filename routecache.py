@@ -0,0 +1,89 @@
+import re
+import time
+import sqlite3
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Seconds after which a cached itinerary is requested again
+TTL = 24 * 3600
+# Number of itineraries kept, the least recently used are removed above it
+MAX_ENTRIES = 10000
+
+class RouteCache(object):
+    """
+    Persistent cache of the google maps itineraries (see utils.gmaps_parser),
+    keyed by the normalized start point, end point and mode, so that the same
+    commute does not need to call the API at every request.
+    The decoded lon, lat and dtime are kept in a sqlite database, which
+    survives the restarts and is shared by all the workers of the machine.
+    Entries older than ttl seconds are not used anymore, when there are more
+    than max_entries the least recently used ones are removed.
+    """
+    def __init__(self, path, ttl=TTL, max_entries=MAX_ENTRIES):
+        self.path = str(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS routes (
+                            key TEXT PRIMARY KEY, created REAL, accessed REAL,
+                            lon BLOB, lat BLOB, dtime BLOB)""")
+
+    @staticmethod
+    def key(start_point, end_point, mode):
+        """
+        Key of an itinerary: case and spaces in the addresses do not matter.
+        """
+        def normalize(value):
+            return re.sub(r'\s+', ' ', (value or '').strip().lower())
+
+        return '|'.join(normalize(value) for value in (start_point, end_point, mode))
+
+    def get(self, key, now=None):
+        """
+        Return lon, lat and dtime of a cached itinerary, None if not
+        in the cache or expired.
+        """
+        now = time.time() if now is None else now
+        with self._connect() as db:
+            row = db.execute("SELECT lon, lat, dtime FROM routes WHERE key = ? AND created > ?",
+                             (key, now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE routes SET accessed = ? WHERE key = ?", (now, key))
+        lon, lat, dtime = row
+
+        return (np.frombuffer(lon, dtype=np.float64), np.frombuffer(lat, dtype=np.float64),
+                pd.to_timedelta(np.frombuffer(dtime, dtype=np.int64), unit='ns'))
+
+    def put(self, key, lon, lat, dtime, now=None):
+        """
+        Store an itinerary, removing the expired and the least recently used ones.
+        """
+        now = time.time() if now is None else now
+        dtime = np.asarray(dtime, dtype='timedelta64[ns]').astype(np.int64)
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?)",
+                       (key, now, now,
+                        np.asarray(lon, dtype=np.float64).tobytes(),
+                        np.asarray(lat, dtype=np.float64).tobytes(),
+                        dtime.tobytes()))
+            db.execute("DELETE FROM routes WHERE created <= ?", (now - self.ttl,))
+            db.execute("""DELETE FROM routes WHERE key NOT IN (
+                            SELECT key FROM routes ORDER BY accessed DESC LIMIT ?)""",
+                       (self.max_entries,))
+
+    @contextmanager
+    def _connect(self):
+        """
+        A new connection for every operation, as connections cannot be shared
+        between threads or forked processes. Commits at the end of the block.
+        """
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
@@ -0,0 +1,88 @@
+import io
+import sys
+import tarfile
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# The modules of the app are at the top level of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import utils
+from refresher import Forecast, RETRY_INTERVAL
+from trackcache import TrackCache
+from routecache import RouteCache
+from resultcache import ResultCache
+
+RADOLAN_HEADER = ("FX{time:%d%H%M}10000{time:%m%y}BY{size:07d}VS 3SW   2.13.1PR E+00INT   5"
+                  "GP 900x 900VV {minute:03d}MF 00000002MS 58"
+                  "<boo,ros,emd,hnr,umd,pro,ess,fld,drs,neu,nhb,oft,eis,tur,isn,fbg,mem>")
+
+def radolan_composite(basetime, minute, data):
+    """
+    A RADOLAN FX composite as served by DWD, with the RVP6 values in data (900x900).
+    """
+    payload = np.asarray(data, dtype='<u2').tobytes()
+    size = len(RADOLAN_HEADER.format(time=basetime, size=0, minute=minute)) + 1 + len(payload)
+
+    return (RADOLAN_HEADER.format(time=basetime, size=size, minute=minute).encode()
+            + b'\x03' + payload)
+
+def fx_archive(basetime, steps=25, seed=0):
+    """
+    Bytes of an FX_LATEST.tar.bz2 archive with the given number of forecast steps.
+    The rain is random over blocks of 30x30 km, so that tracks a few km apart
+    get different values, plus some noise (bz2 is very slow on constant blocks).
+    """
+    rng = np.random.RandomState(seed)
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:bz2') as tar:
+        for step in range(steps):
+            data = (np.kron(rng.randint(0, 200, size=(30, 30)), np.ones((30, 30), dtype=int))
+                    + rng.randint(0, 4, size=(900, 900)))
+            member = radolan_composite(basetime, step * 5, data)
+            info = tarfile.TarInfo('FX{:%y%m%d%H%M}_{:03d}_MF002'.format(basetime, step * 5))
+            info.size = len(member)
+            tar.addfile(info, io.BytesIO(member))
+
+    return archive.getvalue()
+
+@pytest.fixture(scope='session')
+def forecast():
+    """
+    A decoded forecast of 25 steps (2 hours), as published by the refresher.
+    """
+    forecast = Forecast(*utils.decode_radar_archive([fx_archive(datetime(2019, 3, 5, 8, 30))]))
+    forecast.rr.flags.writeable = False
+
+    return forecast
+
+class StaticRefresher(object):
+    """
+    Stand-in for refresher.ForecastRefresher that always has the same forecast.
+    """
+    def __init__(self, forecast):
+        self.forecast = forecast
+        self.retry_interval = RETRY_INTERVAL
+
+    def current(self, timeout=None):
+        return self.forecast
+
+@pytest.fixture
+def app(monkeypatch, tmp_path, forecast):
+    """
+    The webapp, with its caches in tmp_path and serving the forecast fixture.
+    """
+    import radar_forecast_bike
+    # Only matters for the first import, which creates the default caches
+    monkeypatch.setattr(radar_forecast_bike, 'data_path', tmp_path)
+    import webapp
+
+    monkeypatch.setattr(webapp, 'refresher', StaticRefresher(forecast))
+    monkeypatch.setattr(webapp, 'track_cache', TrackCache(tmp_path/'tracks'))
+    monkeypatch.setattr(webapp, 'route_cache', RouteCache(tmp_path/'routes.sqlite'))
+    monkeypatch.setattr(webapp, 'result_cache', ResultCache())
+
+    return webapp
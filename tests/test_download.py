@@ -0,0 +1,93 @@
+import hashlib
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import utils
+from conftest import fx_archive
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the DWD server: serves server.archive with an ETag,
+    answers 304 to a matching If-None-Match (or with server.status, if set)
+    and counts the requests and the bytes of the bodies that it sends.
+    """
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        etag = '"{}"'.format(hashlib.md5(server.archive).hexdigest())
+        if server.status is not None:
+            self.send_error(server.status)
+            return
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', 'Tue, 05 Mar 2019 08:35:00 GMT')
+        self.send_header('Content-Length', str(len(server.archive)))
+        self.end_headers()
+        self.wfile.write(server.archive)
+        server.bytes_served += len(server.archive)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def dwd(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ArchiveHandler)
+    server.requests, server.bytes_served, server.status = 0, 0, None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(utils, 'URL_RADAR',
+                        'http://127.0.0.1:{}/FX_LATEST.tar.bz2'.format(server.server_port))
+    monkeypatch.setattr(utils, '_stream_cache', {})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_revalidation(dwd, tmp_path, stream):
+    # A forecast of an old cycle must be revalidated...
+    dwd.archive = fx_archive(datetime(2019, 3, 5, 8, 30), steps=3)
+    first = utils.get_radar_data(tmp_path, stream=stream)
+    assert (dwd.requests, dwd.bytes_served) == (1, len(dwd.archive))
+
+    # ...and the server answers 304 if it did not change
+    utils.get_radar_data(tmp_path, stream=stream)
+    assert (dwd.requests, dwd.bytes_served) == (2, len(dwd.archive))
+
+    # A new forecast is downloaded again...
+    served = dwd.bytes_served
+    dwd.archive = fx_archive(datetime.utcnow().replace(second=0, microsecond=0), steps=3, seed=1)
+    latest = utils.get_radar_data(tmp_path, stream=stream)
+    assert (dwd.requests, dwd.bytes_served) == (3, served + len(dwd.archive))
+    assert latest[2][0] != first[2][0]
+    assert (latest[4] != first[4]).any()
+
+    # ...and then, until its 5 minutes cycle is over, the server is not even asked
+    for _ in range(5):
+        utils.get_radar_data(tmp_path, stream=stream)
+    assert (dwd.requests, dwd.bytes_served) == (3, served + len(dwd.archive))
+
+def test_error_keeps_local_files(dwd, tmp_path):
+    dwd.archive = fx_archive(datetime(2019, 3, 5, 8, 30), steps=3)
+    first = utils.get_radar_data(tmp_path)
+    files = sorted(tmp_path.glob('*_MF002'))
+    freshness = (tmp_path/utils.FRESHNESS_FILENAME).read_text()
+
+    dwd.status = 503
+    with pytest.raises(requests.HTTPError):
+        utils.get_radar_data(tmp_path)
+    assert sorted(tmp_path.glob('*_MF002')) == files
+    assert (tmp_path/utils.FRESHNESS_FILENAME).read_text() == freshness
+
+    # Once the server is back the local files are still valid
+    dwd.status = None
+    served = dwd.bytes_served
+    again = utils.get_radar_data(tmp_path)
+    assert dwd.bytes_served == served
+    assert (again[4] == first[4]).all()
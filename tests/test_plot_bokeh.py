@@ -0,0 +1,51 @@
+import json
+import threading
+from pathlib import Path
+
+import numpy as np
+
+import plot_bokeh
+import radar_forecast_bike
+import utils
+
+TRACK = str(Path(__file__).resolve().parents[1]/'track_points.csv')
+
+def test_page_shell_concurrent_first_calls(monkeypatch):
+    for _ in range(50):
+        monkeypatch.setattr(plot_bokeh, '_page', None)
+        barrier = threading.Barrier(8)
+        shells = []
+
+        def build():
+            barrier.wait()
+            shells.append(plot_bokeh.page_shell())
+
+        threads = [threading.Thread(target=build) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(shells) == 8
+        assert all(len(shell) == 2 for shell in shells + [plot_bokeh.page_shell()])
+
+def test_totals_in_labels(forecast):
+    df = radar_forecast_bike.main(track_file=TRACK, forecast=forecast)
+    per_point = radar_forecast_bike.main(track_file=TRACK, forecast=forecast, per_point=True)
+    # The compacted track is not evenly spaced, but gives the same totals
+    assert len(df) < len(per_point)
+    totals = utils.total_rain(per_point)
+    assert np.allclose(utils.total_rain(df), totals)
+
+    item = json.dumps(plot_bokeh.plot_item(df))
+    for departure, total in zip(df.columns, totals):
+        assert 'start {:%H:%M}, tot. {:4.2f} mm'.format(departure, total) in item
+
+def test_runs_drawn_as_steps(forecast):
+    df = radar_forecast_bike.main(track_file=TRACK, forecast=forecast)
+    item = plot_bokeh.plot_item(df)
+    models = item['doc']['roots']['references']
+    # Every renderer also has its glyph for the non-selected state
+    steps = [model['attributes'] for model in models if model['type'] == 'Step']
+    assert len(steps) == 2 * len(df.columns)
+    assert all(step['mode'] == 'after' for step in steps)
+    assert not [model for model in models if model['type'] == 'Line']
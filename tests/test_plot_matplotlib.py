@@ -0,0 +1,51 @@
+import io
+import os
+import gc
+import resource
+from pathlib import Path
+
+import pytest
+
+import plot_matplotlib
+import radar_forecast_bike
+
+TRACK = str(Path(__file__).resolve().parents[1]/'track_points.csv')
+# Renders of the soak test, and how much the memory may grow meanwhile.
+# It takes minutes, so it only runs if SOAK_TESTS is set in the environment
+SOAK_RENDERS = 2000
+SOAK_MAX_GROWTH = 16 * 1024 * 1024
+
+def rss():
+    """
+    Resident memory of this process (bytes).
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+def test_runs_drawn_as_steps(forecast):
+    df = radar_forecast_bike.main(track_file=TRACK, forecast=forecast)
+    fig = plot_matplotlib.make_plot(df)
+    lines = [line for line in fig.axes[0].get_lines() if line.get_visible()]
+    assert len(lines) == len(df.columns)
+    assert all(line.get_drawstyle() == 'steps-post' for line in lines)
+
+@pytest.mark.skipif(not os.environ.get('SOAK_TESTS'), reason="soak test, set SOAK_TESTS to run it")
+@pytest.mark.skipif(not os.path.exists('/proc/self/statm'), reason="needs /proc")
+def test_memory_stays_flat(forecast):
+    # Different numbers of departures, so that the lines and the legends change too
+    dfs = [radar_forecast_bike.main(track_file=TRACK, forecast=forecast, shifts=shifts)
+           for shifts in (None, (0, 2), (1, 3, 5, 7, 9))]
+
+    def render(count):
+        for i in range(count):
+            plot = io.BytesIO()
+            plot_matplotlib.make_plot(dfs[i % len(dfs)], out_filename=plot)
+            assert plot.getvalue().startswith(b'\x89PNG')
+        gc.collect()
+
+    # The first renders load fonts, caches...
+    render(100)
+    start = rss()
+    # ...after which the memory must not grow anymore
+    render(SOAK_RENDERS)
+    assert rss() - start < SOAK_MAX_GROWTH
@@ -0,0 +1,46 @@
+import threading
+from pathlib import Path
+
+import radar_forecast_bike
+from trackcache import TrackCache
+from resultcache import ResultCache
+
+TRACK = str(Path(__file__).resolve().parents[1]/'track_points.csv')
+
+class WatchedTrackCache(TrackCache):
+    """
+    TrackCache telling when a track is looked up.
+    """
+    def __init__(self, root):
+        super().__init__(root)
+        self.looked_up = threading.Event()
+
+    def get(self, key):
+        self.looked_up.set()
+        return super().get(key)
+
+def test_track_read_while_forecast_retrieved(forecast, tmp_path):
+    track_cache, result_cache = WatchedTrackCache(tmp_path), ResultCache()
+
+    def retrieve_forecast():
+        # The forecast only comes once the track is being read
+        assert track_cache.looked_up.wait(5)
+        return forecast
+
+    df = radar_forecast_bike.main(track_file=TRACK, forecast=retrieve_forecast,
+                                  track_cache=track_cache, result_cache=result_cache)
+    again = radar_forecast_bike.main(track_file=TRACK, forecast=forecast,
+                                     track_cache=track_cache, result_cache=result_cache)
+
+    assert again is df
+    assert result_cache.stats()['hits'] == 1
+
+def test_result_cache_with_plain_tuple(forecast):
+    # As returned by utils.get_radar_data, the default forecast of main
+    result_cache = ResultCache()
+    df = radar_forecast_bike.main(track_file=TRACK, forecast=tuple(forecast), result_cache=result_cache)
+    again = radar_forecast_bike.main(track_file=TRACK, forecast=lambda: tuple(forecast),
+                                     result_cache=result_cache)
+
+    assert again is df
+    assert result_cache.stats()['hits'] == 1
@@ -0,0 +1,114 @@
+import io
+
+import numpy as np
+import pytest
+
+import radolan
+
+# The decoder of the run-length coded composites as it was before being
+# vectorized, frozen here as the reference: one np.append per run byte
+
+def old_decode_runlength_line(line, attrs):
+    lo = 1
+    byte = line[lo]
+    if byte == 10:
+        return np.ones(attrs['ncol'], dtype=np.uint8) * attrs['nodataflag']
+    offset = byte - 16
+    while byte == 255:
+        lo += 1
+        byte = line[lo]
+        offset += byte - 16
+    dline = line[lo + 1:]
+    for lo, byte in enumerate(dline):
+        if byte == 10:
+            break
+        width = (byte & 0xF0) >> 4
+        val = byte & 0x0F
+        if lo == 0:
+            arr = np.ones(offset, dtype=np.uint8) * attrs['nodataflag']
+        arr = np.append(arr, np.ones(width, dtype=np.uint8) * val)
+    trailing = attrs['ncol'] - len(arr)
+    if trailing > 0:
+        arr = np.append(arr, np.ones(trailing, dtype=np.uint8) * attrs['nodataflag'])
+    elif trailing < 0:
+        arr = dline[:trailing]
+    return arr
+
+def old_decode_runlength_array(binarr, attrs):
+    buf = io.BytesIO(binarr)
+    line = radolan.read_radolan_runlength_line(buf)
+    arr = old_decode_runlength_line(line, attrs)
+    line = radolan.read_radolan_runlength_line(buf)
+    while line is not None:
+        arr = np.vstack((arr, old_decode_runlength_line(line, attrs)))
+        line = radolan.read_radolan_runlength_line(buf)
+    return np.flipud(arr)
+
+def runlength_payload(rng, nrow, ncol):
+    """
+    Random run-length coded lines: empty ones, offsets of one and of many
+    bytes (255 continues the offset), with and without trailing nodata.
+    """
+    payload = bytearray()
+    # Offsets around the 239 pixels that fit in one byte come first
+    offsets = [0, 238, 239, 240, 478] + [None] * (nrow - 5)
+    for row, offset in enumerate(offsets):
+        # The line number, anything but a line feed
+        payload.append(row % 200 + 11)
+        kind = rng.randint(4)
+        if offset is None and kind == 0:
+            payload.append(10)
+            continue
+        if offset is None:
+            offset = rng.randint(0, 3) if kind == 1 else rng.randint(200, ncol - 20)
+        rest = offset
+        while rest >= 239:
+            payload.append(255)
+            rest -= 239
+        payload.append(16 + rest)
+        trailing = rng.randint(0, min(40, ncol - offset - 1)) if kind == 3 else 0
+        left = ncol - offset - trailing
+        while left > 0:
+            width = min(rng.randint(1, 16), left)
+            payload.append((width << 4) | rng.randint(16))
+            left -= width
+        payload.append(10)
+    payload.append(4)
+
+    return bytes(payload)
+
+@pytest.mark.parametrize('nodata', [255, -9999])
+def test_runlength_same_as_old_decoder(nodata):
+    rng = np.random.RandomState(0)
+    attrs = {'nrow': 80, 'ncol': 600, 'nodataflag': nodata}
+    for _ in range(5):
+        binarr = runlength_payload(rng, attrs['nrow'], attrs['ncol'])
+        old = old_decode_runlength_array(binarr, attrs)
+        new = radolan.decode_radolan_runlength_array(binarr, attrs)
+        assert (new.dtype, new.shape) == (old.dtype, old.shape)
+        assert new.tobytes() == old.tobytes()
+
+def test_grid_corner():
+    # The lower left corner published in the RADOLAN format description
+    lon, lat = radolan.get_latlon_radar()
+    assert np.allclose([lon[0, 0], lat[0, 0]], [3.5889, 46.9526], atol=1e-4)
+
+def test_projection_round_trip():
+    rng = np.random.RandomState(0)
+    lon, lat = rng.uniform(2, 18, 1000), rng.uniform(46, 56, 1000)
+    x, y = radolan.get_radolan_xy_from_lonlat(lon, lat)
+    assert np.allclose(radolan.get_radolan_lonlat_from_xy(x, y), (lon, lat), rtol=0, atol=1e-9)
+    assert np.allclose(radolan.get_radolan_xy_from_lonlat(*radolan.get_radolan_lonlat_from_xy(x, y)),
+                       (x, y), rtol=0, atol=1e-9)
+
+def test_rowcol_same_as_nearest_grid_point():
+    lon_grid, lat_grid = np.radians(radolan.get_latlon_radar())
+    rng = np.random.RandomState(0)
+    lon, lat = rng.uniform(6, 15, 50), rng.uniform(47.5, 54.8, 50)
+    row, col = radolan.get_radolan_rowcol(lon, lat)
+
+    for i in range(len(lon)):
+        # Great-circle distance (haversine) to every point of the grid
+        p, q = np.radians(lon[i]), np.radians(lat[i])
+        h = np.sin((lat_grid - q) / 2) ** 2 + np.cos(q) * np.cos(lat_grid) * np.sin((lon_grid - p) / 2) ** 2
+        assert np.unravel_index(np.argmin(h), h.shape) == (row[i], col[i])
@@ -0,0 +1,50 @@
+import os
+import fcntl
+import threading
+from datetime import datetime
+
+import numpy as np
+import pytest
+import requests
+
+from cubestore import CubeStore
+from refresher import ForecastRefresher, ForecastUnavailable
+
+def failing_update(url=None):
+    raise requests.ConnectionError("DWD is down")
+
+def test_store_used_when_update_fails(tmp_path, monkeypatch):
+    store = CubeStore(tmp_path)
+    rr = np.arange(3 * 4 * 5, dtype=np.uint8).reshape(3, 4, 5)
+    store.publish(rr, [datetime(2019, 3, 5, 8, 30 + 5 * step) for step in range(3)],
+                  {'basetime': '2019-03-05T08:30:00'})
+    monkeypatch.setattr(store, 'update', failing_update)
+
+    refresher = ForecastRefresher(tmp_path, store=store)
+    assert refresher.refresh()
+    assert (refresher.current().rr == rr).all()
+
+def test_current_times_out(tmp_path, monkeypatch):
+    store = CubeStore(tmp_path)
+    monkeypatch.setattr(store, 'update', failing_update)
+
+    refresher = ForecastRefresher(tmp_path, store=store, retry_interval=3600, timeout=0.1)
+    with pytest.raises(ForecastUnavailable):
+        refresher.current()
+
+def test_waits_for_the_first_update_of_another_process(tmp_path):
+    store = CubeStore(tmp_path)
+    rr = np.arange(3 * 4 * 5, dtype=np.uint8).reshape(3, 4, 5)
+    # Another worker is downloading the first forecast...
+    fd = os.open(str(tmp_path/'update.lock'), os.O_RDONLY | os.O_CREAT)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+
+    def publish():
+        store.publish(rr, [datetime(2019, 3, 5, 8, 30 + 5 * step) for step in range(3)],
+                      {'basetime': '2019-03-05T08:30:00'})
+        os.close(fd)
+
+    # ...and publishes it a bit later, much before the next retry
+    threading.Timer(0.5, publish).start()
+    refresher = ForecastRefresher(tmp_path, store=store, retry_interval=3600, timeout=5)
+    assert (refresher.current().rr == rr).all()
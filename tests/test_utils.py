@@ -0,0 +1,123 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import radolan
+import utils
+
+TRACK = str(Path(__file__).resolve().parents[1]/'track_points.csv')
+
+def test_track_longer_than_horizon(forecast):
+    lon, lat, dtime = utils.read_input(TRACK)
+    # About 3 hours, against the 2 hours of the forecast
+    dtime = dtime * 8
+    assert not utils.feasible_shifts(dtime, forecast.dtime_radar).size
+
+    with pytest.raises(utils.InvalidShifts):
+        utils.extract_rain_rate_from_radar(lon, lat, dtime, forecast.lon_radar, forecast.lat_radar,
+                                           forecast.dtime_radar, forecast.rr, shifts=None)
+    with pytest.raises(utils.InvalidShifts):
+        utils.extract_rain_rate_from_radar(lon, lat, dtime, forecast.lon_radar, forecast.lat_radar,
+                                           forecast.dtime_radar, forecast.rr, shifts=(0,))
+    with pytest.raises(ValueError):
+        utils.best_departure_times(lon, lat, dtime, forecast.lon_radar, forecast.lat_radar,
+                                   forecast.time_radar, forecast.dtime_radar, forecast.rr)
+
+@pytest.mark.parametrize('minutes, count', [(0, 25), (2.5, 25), (117.5, 2), (122.5, 1),
+                                            (122.6, 0), (180, 0)])
+def test_feasible_shifts(forecast, minutes, count):
+    lon, lat = np.full(2, 10.), np.full(2, 53.6)
+    dtime = pd.to_timedelta([0, minutes], unit='m')
+    shifts = utils.feasible_shifts(dtime, forecast.dtime_radar)
+    assert (shifts == np.arange(count)).all()
+
+    # The same departures as best_departure_times
+    if count:
+        best = utils.best_departure_times(lon, lat, dtime, forecast.lon_radar, forecast.lat_radar,
+                                          forecast.time_radar, forecast.dtime_radar, forecast.rr,
+                                          freq='5min', n=100)
+        assert len(best) == count
+
+def departure_scores(lon, lat, dtime, forecast, departure, threshold=0.1):
+    """
+    Scores of best_departure_times for one departure, gathering the rain
+    at every point of the track.
+    """
+    offset = (departure - forecast.time_radar[0]).value
+    dtime = np.asarray(dtime, dtype='timedelta64[ns]').astype(np.int64)
+    rain = utils.extract_rain_rate_from_radar(lon, lat, dtime + offset, forecast.lon_radar, forecast.lat_radar,
+                                              forecast.dtime_radar, forecast.rr, shifts=(0,))[0]
+    hours = np.append(np.diff(dtime), 0) / 3600e9
+
+    return {'total': hours.dot(rain), 'peak': rain.max(), 'wet': ((rain > threshold) * hours * 60.).sum()}
+
+@pytest.mark.parametrize('metric', ['total', 'peak', 'wet'])
+@pytest.mark.parametrize('freq, earliest', [('5min', None), ('2min', None),
+                                            ('1min', '2019-03-05 10:12:30'), ('30s', '2019-03-05 09:59:00')])
+def test_best_departure_times_same_as_brute_force(forecast, metric, freq, earliest):
+    lon, lat, dtime = utils.read_input(TRACK)
+    if earliest is not None:
+        # Local time of Berlin, as time_radar
+        earliest = pd.Timestamp(earliest)
+    # Every candidate departure
+    best = utils.best_departure_times(lon, lat, dtime, forecast.lon_radar, forecast.lat_radar,
+                                      forecast.time_radar, forecast.dtime_radar, forecast.rr,
+                                      metric=metric, freq=freq, earliest=earliest, n=10 ** 6)
+
+    step = pd.to_timedelta(freq)
+    first = forecast.time_radar[0] if earliest is None else earliest.ceil(freq)
+    horizon = forecast.time_radar[-1] + pd.Timedelta('2.5min') - dtime[-1]
+    assert sorted(best.index) == list(pd.date_range(first, horizon, freq=step))
+    assert (np.diff(best[metric].values) >= 0).all()
+    for departure, scores in best.iterrows():
+        expected = departure_scores(lon, lat, dtime, forecast, departure)
+        assert np.allclose([scores[key] for key in ('total', 'peak', 'wet')],
+                           [expected[key] for key in ('total', 'peak', 'wet')])
+
+def test_best_departure_times_unknown_metric(forecast):
+    lon, lat, dtime = utils.read_input(TRACK)
+    with pytest.raises(ValueError, match='Unknown metric'):
+        utils.best_departure_times(lon, lat, dtime, forecast.lon_radar, forecast.lat_radar,
+                                   forecast.time_radar, forecast.dtime_radar, forecast.rr, metric='wettest')
+
+def box_stat(rr, step, rows, cols, stat, threshold=0.1):
+    """
+    stat of extract_corridor_rain over the box rows x cols of step, from every value.
+    """
+    codes = rr[step, rows[0]:rows[1], cols[0]:cols[1]]
+    if stat == 'max':
+        codes = codes[codes != utils.NODATA_CODE]
+        return utils.RAIN_RATE_LUT[codes.max() if codes.size else utils.NODATA_CODE]
+    values = utils.RAIN_RATE_LUT[codes]
+    if stat == 'coverage':
+        values = values > threshold
+
+    return values.mean()
+
+@pytest.mark.parametrize('stat', ['mean', 'coverage', 'max'])
+@pytest.mark.parametrize('radius', [0, 2, 10])
+def test_corridor_same_as_brute_force(forecast, radius, stat):
+    rr = forecast.rr.copy()
+    nrow, ncol = rr.shape[1:]
+    # Some missing data, a whole box of it around the second point
+    rr[:, ::7, ::5] = utils.NODATA_CODE
+    rr[:, 890 - radius:891 + radius, 5 - min(radius, 5):6 + radius] = utils.NODATA_CODE
+    # Points on the grid, also close to the borders where the boxes are cut
+    rows = np.array([0, 890, 450, 897, 3, 899, 120])
+    cols = np.array([0, 5, 450, 2, 896, 899, 700])
+    lon_grid, lat_grid = radolan.get_latlon_radar()
+    lon, lat = lon_grid[rows, cols], lat_grid[rows, cols]
+    dtime = pd.to_timedelta(np.arange(len(rows)) * 4, unit='m')
+    shifts = (0, 3, 7)
+
+    rain = utils.extract_corridor_rain(lon, lat, dtime, forecast.lon_radar, forecast.lat_radar,
+                                       forecast.dtime_radar, rr, radius=radius, stat=stat, shifts=shifts)
+
+    steps = utils.time_indices(dtime, forecast.dtime_radar)
+    for i, shift in enumerate(shifts):
+        for j, (row, col) in enumerate(zip(rows, cols)):
+            box_rows = (max(row - radius, 0), min(row + radius + 1, nrow))
+            box_cols = (max(col - radius, 0), min(col + radius + 1, ncol))
+            assert np.isclose(rain[i, j], box_stat(rr, steps[j] + shift, box_rows, box_cols, stat))
@@ -0,0 +1,96 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+import pytest
+import requests
+
+from cubestore import CubeStore
+from refresher import ForecastRefresher
+
+TRACK = str(Path(__file__).resolve().parents[1]/'track_points.csv')
+
+def test_no_forecast_gives_503(app, tmp_path, monkeypatch):
+    store = CubeStore(tmp_path/'cubes')
+    monkeypatch.setattr(store, 'update', lambda url=None: requests.get('http://127.0.0.1:9/'))
+    monkeypatch.setattr(app, 'refresher', ForecastRefresher(tmp_path, store=store,
+                                                            retry_interval=3600, timeout=0.1))
+
+    response = app.server.test_client().post('/forecast')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '3600'
+
+def uploads(count):
+    """
+    count different tracks (the example one moved by some km), uploaded
+    with only two different file names.
+    """
+    track = pd.read_csv(TRACK)
+    for i in range(count):
+        moved = track.assign(X=track.X + 0.15 * i, Y=track.Y - 0.07 * i)
+        yield moved.to_csv(index=False).encode(), 'track.csv' if i % 2 else 'other.csv'
+
+def test_parallel_uploads(app, tmp_path, monkeypatch):
+    cwd = tmp_path/'cwd'
+    cwd.mkdir()
+    monkeypatch.chdir(cwd)
+    tracks = list(uploads(6))
+
+    def post(i):
+        data, filename = tracks[i % len(tracks)]
+        # Flask test clients cannot be shared between threads
+        response = app.server.test_client().post(
+            '/make_plot', data={'file': (io.BytesIO(data), filename), 'shifts': 'all'},
+            content_type='multipart/form-data')
+        assert response.status_code == 200
+        assert response.mimetype == 'image/png'
+        return i % len(tracks), response.data
+
+    # The plot of every track, one request at a time...
+    expected = dict(post(i) for i in range(len(tracks)))
+    assert len(set(expected.values())) == len(tracks)
+
+    # ...is the same when many requests are running at the same time...
+    with ThreadPoolExecutor(6) as pool:
+        for i, plot in pool.map(post, range(8 * len(tracks))):
+            assert plot == expected[i]
+    # ...and nothing is written in the working directory
+    assert list(cwd.iterdir()) == []
+
+@pytest.mark.parametrize('url', ['/forecast', '/make_plot', '/make_plot_file'])
+@pytest.mark.parametrize('shifts', ['a', '1,,2', '40', '-1'])
+def test_invalid_shifts_give_400(app, url, shifts):
+    response = app.server.test_client().post(url, data={'shifts': shifts})
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('url', ['/forecast', '/make_plot', '/make_plot_file'])
+def test_track_longer_than_horizon_gives_400(app, url):
+    track = pd.read_csv(TRACK)
+    time = pd.to_datetime(track.time)
+    # About 3 hours, against the 2 hours of the forecast
+    track['time'] = (time[0] + (time - time[0]) * 8).dt.strftime('%Y-%m-%d %H:%M:%S')
+    data = track.to_csv(index=False).encode()
+
+    response = app.server.test_client().post(
+        url, data={'file': (io.BytesIO(data), 'slow.csv'), 'shifts': 'all'},
+        content_type='multipart/form-data')
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('url', ['/forecast', '/make_plot', '/make_plot_file'])
+def test_upload_hashed_once(app, url, monkeypatch):
+    import trackcache
+    hashed = []
+    hash_blocks = trackcache._hash_blocks
+
+    def counting_hash_blocks(digest, f):
+        hashed.append(f)
+        hash_blocks(digest, f)
+
+    monkeypatch.setattr(trackcache, '_hash_blocks', counting_hash_blocks)
+    data, filename = next(uploads(1))
+
+    response = app.server.test_client().post(
+        url, data={'file': (io.BytesIO(data), filename)}, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert len(hashed) == 1
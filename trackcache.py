@@ -0,0 +1,115 @@
+import os
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Total size of the cached tracks, the least recently used are removed above it
+MAX_BYTES = 64 * 1024 * 1024
+# Block size used to hash the uploaded files
+HASH_BLOCK_SIZE = 1 << 20
+
+class TrackCache(object):
+    """
+    On-disk cache of the parsed tracks, keyed by the hash of the content of
+    the file, so that the same track uploaded again (e.g. the daily commute)
+    does not need to be parsed. Every track is stored in a compact binary
+    file with three columns: lon and lat as float32 and the time offsets
+    from the first point as int64 nanoseconds.
+    The modification time of the files is used as last access time,
+    when the total size goes above max_bytes the oldest tracks are removed.
+    """
+    def __init__(self, root, max_bytes=MAX_BYTES):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(track_file, filename=None):
+        """
+        Key of a track file: the format (extension of filename, by default
+        the track_file path) and the hash of its content. track_file can also
+        be a file-like object, which is rewound to where it was afterwards.
+        """
+        if filename is None:
+            filename = track_file
+        digest = hashlib.sha1()
+        if hasattr(track_file, 'read'):
+            position = track_file.tell()
+            _hash_blocks(digest, track_file)
+            track_file.seek(position)
+        else:
+            with open(track_file, 'rb') as f:
+                _hash_blocks(digest, f)
+
+        return '{}-{}'.format(os.path.splitext(filename)[1].lstrip('.').lower(),
+                              digest.hexdigest())
+
+    def get(self, key):
+        """
+        Return lon, lat and dtime of a cached track, None if not in the cache.
+        """
+        path = self.root/key
+        try:
+            with open(str(path), 'rb') as f:
+                lon, lat, dtime = np.load(f), np.load(f), np.load(f)
+        except (IOError, ValueError):
+            return None
+        try:
+            os.utime(str(path))
+        except OSError:
+            # Removed in the meantime, we have the data anyway
+            pass
+
+        return self._track(lon, lat, dtime)
+
+    def put(self, key, lon, lat, dtime):
+        """
+        Store a track and return it as it would be returned by get.
+        """
+        lon = np.asarray(lon, dtype=np.float32)
+        lat = np.asarray(lat, dtype=np.float32)
+        dtime = np.asarray(dtime, dtype='timedelta64[ns]').astype(np.int64)
+
+        tmp = self.root/('.{}.{}.tmp'.format(key, os.getpid()))
+        with open(str(tmp), 'wb') as f:
+            for column in (lon, lat, dtime):
+                np.save(f, column)
+        os.replace(str(tmp), str(self.root/key))
+        self.evict()
+
+        return self._track(lon, lat, dtime)
+
+    def evict(self):
+        """
+        Remove the least recently used tracks until the cache fits in max_bytes.
+        """
+        entries = []
+        for path in self.root.iterdir():
+            if path.name.startswith('.'):
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+
+    @staticmethod
+    def _track(lon, lat, dtime):
+        return (lon.astype(np.float64), lat.astype(np.float64),
+                pd.to_timedelta(dtime, unit='ns'))
+
+def _hash_blocks(digest, f):
+    for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+        digest.update(block)
@@ -3,14 +3,25 @@ from datetime import datetime, timedelta
 import re
 import radolan as radar
 import tarfile
+import shutil
 import requests
 import os
+import json
+import io
+import bz2
 import numpy as np
 import sys
+import threading
+import weakref
+from array import array
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
 
-from numba import jit
+# Number of track points whose time is converted at once while reading gpx files
+GPX_TIME_CHUNK = 65536
 
-# Here set the shifts (in units of 5 minutes per shift) for the final forecast
+# Here set the default shifts (in units of 5 minutes per shift) for the final forecast,
+# they can also be chosen for every request
 shifts = (1, 3, 5, 7, 9)
 
 # URL for the radar forecast, may change in the future
@@ -18,65 +29,184 @@ URL_RADAR = "https://opendata.dwd.de/weather/radar/composit/fx/FX_LATEST.tar.bz2
 
 RADAR_FILENAME_REGEX = re.compile("FX\d{10}_(?P<minutes>\d{3})_MF002")
 
-def read_input(track_file):
+# Number of forecast steps (every 5 minutes up to 2 hours) contained
+# in the FX archive, used to preallocate the decoded cube
+FX_STEPS = 25
+
+# Size of the chunks read from the HTTP body when streaming the archive
+STREAM_CHUNK_SIZE = 1 << 20
+
+# A new forecast is published by DWD every 5 minutes: before the end of the
+# cycle of the forecast that we already have there is no need to ask the server
+FORECAST_CYCLE = timedelta(minutes=5)
+
+# Sidecar file, stored next to the extracted data, with the validators 
+# (ETag, Last-Modified) and the basetime of the downloaded forecast
+FRESHNESS_FILENAME = 'FX_LATEST.json'
+
+# Google maps client of every process, see get_gmaps_client
+_gmaps_clients = {}
+_gmaps_lock = threading.Lock()
+
+# In-memory copy of the last streamed forecast and of its validators
+_stream_cache = {}
+
+# Number of threads used to decode the forecast steps, if None 
+# one per core is used
+DECODE_WORKERS = None
+
+# The radar cube is kept as raw uint8 values (RVP6 units, 0.5 dBZ steps
+# starting from -32.5 dBZ) and missing data get this code...
+NODATA_CODE = 255
+# ...while the conversion to mm/h is done when the data is extracted, using
+# a lookup table with the rain rate for each of the 256 possible codes:
+#   rvp6/2. - 32.5 -> dbz,  10. ** (dbz / 10.) -> z,  (z / 256.) ** (1. / 1.42) -> mm/h
+RAIN_RATE_LUT = radar.z_to_r(radar.idecibel(np.arange(256)/2. - 32.5), a=256., b=1.42)
+# Missing data is treated as no precipitation
+RAIN_RATE_LUT[NODATA_CODE] = 0.
+
+def read_input(track_file, cache=None, filename=None, key=None):
     """
     Read track from an external source. Only latitude, longitude and time need
     to be extracted from the file. Currently csv and gpx files are supported. 
     The csv file needs to have 3 variables named exactly time, X and Y. In the
     future this track will be taken from different sources or API.
+    track_file can also be a file-like object (e.g. an uploaded file), which is
+    read directly: filename is then needed to know the format.
+    If a trackcache.TrackCache is given the parsed track is taken from there,
+    when the same file was already read, or stored there. key is the key of
+    the file in the cache, if already known, so that it's not hashed again.
     """
-    if track_file.endswith('.csv'):
-        df = pd.read_csv(track_file)
+    if filename is None:
+        filename = track_file
+    if not (filename.endswith('.csv') or filename.endswith('.gpx')):
+        sys.exit("Only .csv and .gpx files are supported")
+
+    if cache is not None:
+        if key is None:
+            key = cache.key(track_file, filename)
+        track = cache.get(key)
+        if track is not None:
+            return track
+
+    if filename.endswith('.csv'):
+        # Only the columns that we need, the other ones are not even parsed
+        df = pd.read_csv(track_file, usecols=['time', 'X', 'Y'],
+                         dtype={'time': str, 'X': np.float64, 'Y': np.float64})
         time_bike = pd.to_datetime(df.time.values)
         lon_bike, lat_bike = df.X.values, df.Y.values
-    elif track_file.endswith('.gpx'):
-        lon_bike, lat_bike, time_bike = gpx_parser(track_file)
     else:
-        sys.exit("Only .csv and .gpx files are supported")
+        lon_bike, lat_bike, time_bike = gpx_parser(track_file)
 
-    # TODO, filter the track to have points that have a distance
-    # comparable to the radar grid spacing, because that's anyway
-    # the maximum resolution that we can achieve... 
+    # The track is not filtered here: points closer than the radar 
+    # grid spacing are collapsed later by compact_track, because that
+    # also depends on the forecast time steps
     dtime_bike = time_bike - time_bike[0]
 
+    if cache is not None:
+        return cache.put(key, lon_bike, lat_bike, dtime_bike)
+
     return lon_bike, lat_bike, dtime_bike
 
 def gpx_parser(track_file):
     """
     Parse lat, lon and time from a gpx file.
-    We'll have to check whether multiple segments/
-    tracks are a problem while reading. 
-    Requires the gpxpy library.
+    The file is streamed with iterparse: only the lat, lon and time of 
+    the track points (trkpt) are kept, in typed arrays, and every point is
+    discarded as soon as it's read, so that the memory does not depend
+    on the size of the file. Points of multiple tracks/segments are 
+    concatenated in the order in which they appear in the file, while
+    routes and waypoints are ignored.
     Returns 3 array of longitude, latitude and time.
     """
-    import gpxpy
-    lat=[]
-    lon=[]
-    time=[]
-    gpx = gpxpy.parse(open(track_file))
-    for track in gpx.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                lat.append(point.latitude)
-                lon.append(point.longitude)
-                time.append(point.time.replace(tzinfo=None))
-    return np.array(lon), np.array(lat), pd.to_datetime(time)
+    lon, lat, time = array('d'), array('d'), array('q')
+    # Times are converted in chunks, which is much faster than one by one
+    time_chunk = []
+
+    def convert_times():
+        time.extend(pd.to_datetime(time_chunk, utc=True).tz_convert(None)
+                      .values.astype('datetime64[ns]').astype(np.int64))
+        del time_chunk[:]
+
+    # Tag without namespace (GPX 1.0, 1.1...), memoized as there are only a few
+    local_names = {}
+    segment = None
+    for event, elem in ElementTree.iterparse(track_file, events=('start', 'end')):
+        tag = local_names.get(elem.tag)
+        if tag is None:
+            tag = local_names[elem.tag] = elem.tag.rpartition('}')[2]
+        if event == 'start':
+            if tag == 'trkseg':
+                segment = elem
+            continue
+        if tag == 'trkpt':
+            point_time = None
+            for child in elem:
+                if local_names[child.tag] == 'time':
+                    point_time = child.text.strip()
+            if point_time is None:
+                raise ValueError("Track point without time in {}".format(track_file))
+            lat.append(float(elem.get('lat')))
+            lon.append(float(elem.get('lon')))
+            time_chunk.append(point_time)
+            if len(time_chunk) >= GPX_TIME_CHUNK:
+                convert_times()
+            # we don't need the point anymore
+            elem.clear()
+            if segment is not None:
+                segment.remove(elem)
+        elif tag == 'trkseg':
+            segment = None
+            elem.clear()
+        elif tag in ('trk', 'rte', 'wpt'):
+            elem.clear()
+    if time_chunk:
+        convert_times()
+
+    return (np.frombuffer(lon, dtype=np.float64), np.frombuffer(lat, dtype=np.float64),
+            pd.to_datetime(np.frombuffer(time, dtype=np.int64).view('datetime64[ns]')))
+
+def get_gmaps_client():
+    """
+    Google maps client of this process, created the first time it's needed.
+    The client keeps its connections open, so it's shared by all the requests;
+    a new one is created in every forked worker.
+    """
+    with _gmaps_lock:
+        client = _gmaps_clients.get(os.getpid())
+        if client is None:
+            from googlemaps import Client
+            client = _gmaps_clients[os.getpid()] = Client(os.environ['MAPS_API_KEY'])
+
+    return client
 
 def gmaps_parser(start_point="Feuerbergstrasse 6, Hamburg",
-                 end_point="Bundesstrasse 53, Hamburg", mode="bicycling"):
+                 end_point="Bundesstrasse 53, Hamburg", mode="bicycling",
+                 client=None, cache=None):
     """
-    Obtain the track using the google maps api
+    Obtain the track using the google maps api. client is anything with
+    the directions method of googlemaps.Client, by default the one of this
+    process (see get_gmaps_client). If a routecache.RouteCache is given
+    the api is called only if the itinerary is not already there.
     """
-    from googlemaps import Client
-    api_key = os.environ['MAPS_API_KEY']
-    gmaps = Client(api_key)
-    directions = gmaps.directions(start_point, end_point, mode=mode)
+    if cache is not None:
+        key = cache.key(start_point, end_point, mode)
+        track = cache.get(key)
+        if track is not None:
+            return track
+
+    if client is None:
+        client = get_gmaps_client()
+    directions = client.directions(start_point, end_point, mode=mode)
 
     lat_bike = np.array([step['start_location']['lat'] for step in directions[0]['legs'][0]['steps']])
     lon_bike = np.array([step['start_location']['lng'] for step in directions[0]['legs'][0]['steps']])
     time = np.array([step['duration']['value'] for step in directions[0]['legs'][0]['steps']])
     dtime_bike = np.cumsum(pd.to_timedelta(time, unit='s'))
 
+    if cache is not None:
+        cache.put(key, lon_bike, lat_bike, dtime_bike)
+
     return lon_bike, lat_bike, dtime_bike
 
 
@@ -110,19 +240,23 @@ def convert_timezone(dt_from, from_tz='utc', to_tz='Europe/Berlin'):
     # remove again the timezone information
     return dt_to.tz_localize(None)
 
-def download_unpack_file(radar_fn, data_path):
+def download_unpack_file(radar_fn, data_path, response=None):
     """
     Download the latest data from the server and unpack it,
-    returning the list of the  extracted files. 
+    returning the list of the  extracted files. If a (streamed)
+    response for the archive is already available it is used 
+    instead of making a new request.
     """
-
-    response = requests.get(URL_RADAR)
+    if response is None:
+        response = requests.get(URL_RADAR, stream=True)
     # If file is not found raise an exception
     response.raise_for_status()
 
     # Write the file in the specified folder
     with open(radar_fn, 'wb') as f:
-        f.write(response.content)
+        for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+            f.write(chunk)
+    response.close()
 
     # Extract tar file
     tar = tarfile.open(radar_fn, "r:bz2")
@@ -132,138 +266,731 @@ def download_unpack_file(radar_fn, data_path):
 
     return sorted(files)
 
-def get_radar_data(data_path, remove_file=False):
+def read_freshness(data_path):
+    """
+    Read the validators of the forecast stored in data_path, 
+    returns an empty dictionary if there are none.
+    """
+    try:
+        with open(data_path/FRESHNESS_FILENAME) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def write_freshness(data_path, info):
+    """
+    Store the validators next to the extracted files. The file is
+    replaced atomically so that a concurrent reader never sees it half-written.
+    """
+    tmp_fn = data_path/(FRESHNESS_FILENAME + '.tmp')
+    with open(tmp_fn, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp_fn, data_path/FRESHNESS_FILENAME)
+
+def freshness_info(response, basetime):
+    """
+    Collect the validators of the response for the archive together with 
+    the basetime (UTC, as found in the RADOLAN header) of the forecast.
+    """
+    return {'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'basetime': basetime.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def forecast_is_current(info, now=None):
+    """
+    Check whether we are still in the 5 minutes cycle of the forecast 
+    described by info: in this case no newer forecast can exist
+    on the server and we don't even need to ask.
+    """
+    if not info.get('basetime'):
+        return False
+    if now is None:
+        now = datetime.utcnow()
+    basetime = datetime.strptime(info['basetime'], '%Y-%m-%dT%H:%M:%S')
+
+    return basetime <= now < basetime + FORECAST_CYCLE
+
+def conditional_headers(info):
+    """
+    Headers to revalidate the forecast described by info with the server,
+    which will answer with 304 (Not Modified) if it did not change.
+    """
+    headers = {}
+    if info.get('etag'):
+        headers['If-None-Match'] = info['etag']
+    if info.get('last_modified'):
+        headers['If-Modified-Since'] = info['last_modified']
+
+    return headers
+
+class Bz2ChunkStream(object):
+    """
+    Minimal file-like object that decompresses an iterable of bz2
+    compressed chunks (e.g. the body of an HTTP response) on demand. 
+    It only implements read(), which is all that tarfile needs
+    when opened in streaming mode ('r|').
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decompressor = bz2.BZ2Decompressor()
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            if self._decompressor.eof:
+                # Multi-stream archives: start again with the leftover data
+                unused = self._decompressor.unused_data
+                self._decompressor = bz2.BZ2Decompressor()
+                if unused:
+                    self._buffer += self._decompressor.decompress(unused)
+                    continue
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += self._decompressor.decompress(chunk)
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+def read_radar_archive(chunks):
+    """
+    Decode the FX archive while it is being received. chunks is an iterable
+    of bz2 compressed bytes: the tar members are walked as soon as they are
+    decompressed and every member is decoded from an in-memory buffer
+    directly into its slot of a preallocated (steps, nrow, ncol) array,
+    so that nothing is written to disk.
+    Returns the array and the list of validity times (UTC) of the steps.
+    """
+    rr = None
+    time_radar = {}
+
+    with tarfile.open(fileobj=Bz2ChunkStream(chunks), mode='r|') as tar:
+        for member in tar:
+            match = RADAR_FILENAME_REGEX.match(os.path.basename(member.name))
+            if not member.isfile() or not match:
+                continue
+            minute = int(match['minutes'])
+            step = minute // 5
+            buffer = io.BytesIO(tar.extractfile(member).read())
+            rxdata, rxattrs = radar.read_radolan_composite(buffer)
+
+            if rr is None:
+                rr = np.empty(shape=(FX_STEPS,) + rxdata.shape, dtype=np.uint8)
+            encode_radar_data(rxdata, out=rr[step])
+            time_radar[step] = rxattrs['datetime'] + timedelta(minutes=minute)
+
+    if not time_radar or sorted(time_radar) != list(range(len(time_radar))):
+        raise IOError("Forecast steps missing from the radar archive")
+
+    rr = rr[:len(time_radar)]
+
+    time_radar = [time_radar[step] for step in sorted(time_radar)]
+
+    return rr, time_radar
+
+def decode_radar_archive(chunks):
+    """
+    Decode the FX archive from an iterable of compressed chunks, 
+    see read_radar_archive. Returns the same output as process_radar_data.
+    """
+    rr, time_radar = read_radar_archive(chunks)
+
+    return radar_coordinates(time_radar) + (rr,)
+
+def fetch_radar_archive(info=None, url=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Revalidate the forecast described by info (see freshness_info) and, 
+    only if the server has a newer one, download and decode it while 
+    downloading. Returns None if the forecast did not change, otherwise
+    the decoded array, the validity times (UTC) and the new validators.
+    """
+    info = info or {}
+    if forecast_is_current(info):
+        return None
+
+    response = requests.get(url or URL_RADAR, headers=conditional_headers(info),
+                            stream=True)
+    try:
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        rr, time_radar = read_radar_archive(response.iter_content(chunk_size))
+    finally:
+        response.close()
+
+    return rr, time_radar, freshness_info(response, time_radar[0])
+
+def stream_radar_data(url=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Download the latest data from the server and decode it while 
+    downloading, without saving the archive or the extracted files.
+    The decoded forecast is kept in memory together with its validators
+    and revalidated in the same way as get_radar_data does for the files.
+    """
+    info = _stream_cache.get('info', {}) if 'data' in _stream_cache else {}
+
+    result = fetch_radar_archive(info, url, chunk_size)
+    if result is not None:
+        rr, time_radar, info = result
+        data = radar_coordinates(time_radar) + (rr,)
+        _stream_cache.update(info=info, data=data)
+
+    return _stream_cache['data']
+
+def get_radar_data(data_path, remove_file=False, stream=False):
     """
     Get the file from the server, if it's not already downloaded.
     In order to decide whether we need to download the file or not we
-    have to check (1) if the file exists (2) if it exists, whether it's the
-    most recent one. The check (2) for now only compares the size of
-    the local and remote file. This should work in most of the cases
-    but it's not 100% correct. In theory one should extract the timestamp
-    from both files. 
+    keep, next to the extracted files, the validators (ETag and 
+    Last-Modified) returned by the server and the basetime of the forecast. 
+    (1) If the files exist and we're still in the 5 minutes cycle of their
+    basetime no newer forecast can exist, so we don't contact the server.
+    (2) Otherwise we make a conditional request: the server answers with 
+    304 if our copy is still the most recent one, or sends the new archive.
+    If stream is True the archive is instead decoded while downloading
+    and nothing is written in data_path.
     """
+    if stream:
+        return stream_radar_data()
+
     radar_fn = data_path/'FX_LATEST.tar.bz2'
 
-    if not radar_fn.exists():
-        files = download_unpack_file(radar_fn, data_path)
-
-    else: # the file exists 
-        # we have to get the remote size
-        # The size request will be honored on the 
-        # DWD website (hopefully also in the future)
-        response = requests.get(URL_RADAR)
-        remote_size = int(response.headers['Content-Length'])
-        local_size  = int(radar_fn.stat().st_size)
-
-        if local_size != remote_size: # it means
-            # that the remote file changed so the local one is not 
-            # updated: we need to download the file again!
-            #
-            # First remove old files to make space for the new ones...
-            radar_fn.unlink()
-            for file in data_path.glob("*_MF002"):
+    # we need sorted to make sure that the files are ordered in time
+    files = sorted(data_path.glob("*_MF002"))
+    info = read_freshness(data_path) if files else {}
+
+    if not (files and forecast_is_current(info)):
+        response = requests.get(URL_RADAR, headers=conditional_headers(info), 
+                                stream=True)
+
+        if files and response.status_code == 304:
+            # the local files are still the most recent version
+            response.close()
+        else:
+            # the remote file changed (or we don't have any) so we
+            # need to download the file again! Any error (e.g. 503)
+            # must leave the local files untouched...
+            if not response.ok:
+                response.close()
+                response.raise_for_status()
+            # ...so the new archive is first extracted in a staging folder...
+            staging = data_path/'FX_LATEST.partial'
+            shutil.rmtree(str(staging), ignore_errors=True)
+            new_files = download_unpack_file(radar_fn, staging, response)
+            # ...and only then the old files are replaced by the new ones
+            for file in files:
                 if file.exists():
                     file.unlink()
-            # ...and then download
-            files = download_unpack_file(radar_fn, data_path)
-            
-        else: # it means that the file exists and is the most recent version
-            files = sorted(data_path.glob("*_MF002"))
-            # we need sorted to make sure that the files are ordered in time
-
-    # If required remove the tar file, but that means that it will need to be
-    # downloaded next time....
+            for file in new_files:
+                os.replace(str(staging/file), str(data_path/file))
+            shutil.rmtree(str(staging), ignore_errors=True)
+            files = new_files
+            _, rxattrs = radar.read_radolan_composite(data_path/str(files[0]),
+                                                      loaddata=False)
+            write_freshness(data_path, freshness_info(response, rxattrs['datetime']))
+
+    # If required remove the tar file (we only need the extracted files),
+    # and also the validators since the extracted files will be removed as well
     if remove_file:
-        radar_fn.unlink()
+        if radar_fn.exists():
+            radar_fn.unlink()
+        if (data_path/FRESHNESS_FILENAME).exists():
+            (data_path/FRESHNESS_FILENAME).unlink()
 
     # finally get the name of the extracted files
     fnames=[data_path/str(file) for file in files]
 
     return process_radar_data(fnames, remove_file)
 
-def process_radar_data(fnames, remove_file):
+def process_radar_data(fnames, remove_file, workers=None):
     """
     Take the list of files fnames and extract the data using 
     the radolan module, which was extracted from wradlib.
     It also concatenates the files in time and returns
     a numpy array.
+    The files are decoded in parallel by a pool of workers threads 
+    (by default DECODE_WORKERS or one per core), each one writing 
+    its time step in a preallocated array.
      """
-    data = []
-    time_radar = []
+    if workers is None:
+        workers = DECODE_WORKERS or os.cpu_count() or 1
 
-    for fname in fnames:
+    # Use the header of the first file to preallocate the array
+    # !!! The conversion to mm/h is done afterwards to avoid memory usage !!! 
+    _, rxattrs = radar.read_radolan_composite(fnames[0], loaddata=False)
+    rr = np.empty(shape=(len(fnames), rxattrs['nrow'], rxattrs['ncol']), dtype=np.uint8)
+
+    def decode_step(step):
+        fname = fnames[step]
         rxdata, rxattrs = radar.read_radolan_composite(fname)
-        data.append(rxdata)
+        encode_radar_data(rxdata, out=rr[step])
         minute = int(RADAR_FILENAME_REGEX.match(fname.name)['minutes'])
-        time_radar.append((rxattrs['datetime']+timedelta(minutes=minute)))
+        return rxattrs['datetime']+timedelta(minutes=minute)
+
+    if workers > 1 and len(fnames) > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(fnames))) as executor:
+            time_radar = list(executor.map(decode_step, range(len(fnames))))
+    else:
+        time_radar = [decode_step(step) for step in range(len(fnames))]
 
     if remove_file:
         for fname in fnames:
             os.remove(fname)
 
-    # Conversion to numpy array 
-    # !!! The conversion to mm/h is done afterwards to avoid memory usage !!! 
-    data = np.array(data)
+    return radar_coordinates(time_radar) + (rr,)
+
+def encode_radar_data(rxdata, out=None):
+    """
+    Convert the values decoded from a FX file to the uint8 codes of the
+    radar cube. Masked arrays cause too many problems, so missing data
+    (-9999) are marked with NODATA_CODE and treated as no precipitation
+    in the conversion to mm/h.
+    """
+    if out is None:
+        out = np.empty(rxdata.shape, dtype=np.uint8)
+    out[...] = np.rint(np.clip(rxdata, 0, NODATA_CODE - 1))
+    out[rxdata == -9999] = NODATA_CODE
+
+    return out
+
+def rain_rate_cube(rr):
+    """
+    Materialize the rain rate (mm/h) for the whole radar cube, or for 
+    a part of it. Only use this when really needed: the float array
+    takes 8 times the memory of the uint8 cube.
+    """
+    return RAIN_RATE_LUT[rr]
 
-    # Get rid of masking value, we have to check whether this cause problem
-    # In this case missing data is treated as 0 (no precip.). Masked arrays
-    # cause too many problems. 
-    data[data==-9999] = 0.
-    rr = data
+def index_radar_files(fnames):
+    """
+    Build an inventory of the RADOLAN files fnames reading only their
+    headers, without decoding the data. Useful to list archived forecasts.
+    Returns a dataframe with one row per file.
+    """
+    columns = ['file', 'producttype', 'datetime', 'predictiontime',
+               'nrow', 'ncol', 'precision']
+    rows = []
+    for fname in fnames:
+        _, attrs = radar.read_radolan_composite(fname, loaddata=False)
+        rows.append([str(fname)] + [attrs.get(column) for column in columns[1:]])
 
-    # Get coordinates (space/time)
-    lon_radar, lat_radar = radar.get_latlon_radar()
+    return pd.DataFrame(rows, columns=columns)
+
+def radar_coordinates(time_radar):
+    """
+    Get the coordinates (space/time) of the radar data given the list
+    of validity times of the forecast steps.
+    The data is on the RADOLAN grid, for which the closest grid points
+    are computed directly with the projection: lon_radar and lat_radar
+    are None, use radar.get_latlon_radar if they're really needed.
+    """
+    lon_radar, lat_radar = None, None
     time_radar  = convert_timezone(pd.to_datetime(time_radar))
     dtime_radar = time_radar - time_radar[0]
 
-    return lon_radar, lat_radar, time_radar, dtime_radar, rr
-
-@jit(nopython=True)
-def extract_rain_rate_from_radar(lon_bike, lat_bike, dtime_bike, lon_radar, lat_radar, dtime_radar, rr):
-    """
-    Given the longitude, latitude and timedelta objects of the radar and of the bike iterate through 
-    every point of the bike track and find closest point (in time/space) of the radar data. Then 
-    construct the rain_bike array by subsetting the rr array, that is the data from the radar.
-
-    Returns a numpy array with the rain forecast over the bike track.
-    """
-    rain_bike=np.empty(shape=(len(shifts), len(dtime_bike))) # Initialize the array
-    for i, shift in enumerate(shifts):
-        temp = []
-        for lat_b, lon_b, dtime_b in zip(lat_bike, lon_bike, dtime_bike):
-            # Find the index where the two timedeltas object are the same,
-            # note that we can use this as both time from the radar
-            # and the bike are already converted to timedelta, which makes
-            # the comparison quite easy!
-            ind_time = np.argmin(np.abs(dtime_radar - dtime_b))
-            # Find also the closest point in space between radar and the
-            # track from the bike. 
-            dist = np.sqrt((lon_radar-lon_b)**2+(lat_radar-lat_b)**2)
-            indx, indy = dist.argmin()//dist.shape[1], dist.argmin()%dist.shape[1]
-            # Finally append the subsetted value to the array
-            temp.append(rr[ind_time+shift, indx, indy])
-        # iterate over all the shifts
-        rain_bike[i,:] = temp 
-
-    #rain_bike = rain_bike/2. - 32.5 # to corrected units 
-    #rain_bike = 10. ** (rain_bike / 10.) # to dbz
-    #rain_bike = (rain_bike / 256.) ** (1. / 1.42) # to mm/h
-    # All together 
-    rain_bike = ((10. ** ((rain_bike/2. - 32.5) / 10.)) / 256.) ** (1. / 1.42)
-    # With functions but doesn't work with numba
-    #rain_bike = radar.z_to_r(radar.idecibel(rain_bike), a=256, b=1.42) # to mm/h
-    
-    return rain_bike
-
-def convert_to_dataframe(rain_bike, dtime_bike, time_radar):
+    return lon_radar, lat_radar, time_radar, dtime_radar
+
+def time_indices(dtime_bike, dtime_radar):
+    """
+    Find, for every point of the bike track, the index where the two timedeltas 
+    object are the same, note that we can use this as both time from the radar
+    and the bike are already converted to timedelta, which makes
+    the comparison quite easy!
+    """
+    dtime_bike, dtime_radar = np.asarray(dtime_bike), np.asarray(dtime_radar)
+    # The radar steps are sorted in time: the closest one is found by comparing
+    # with the midpoints between steps (on ties the first step, as argmin would do)
+    midpoints = dtime_radar[:-1] + (dtime_radar[1:] - dtime_radar[:-1]) / 2
+
+    return np.searchsorted(midpoints, dtime_bike, side='left')
+
+def shift_horizon(dtime_last, dtime_radar):
+    """
+    Number of shifts (in units of 5 minutes) for which a track whose last point
+    is at dtime_last is covered by the forecast: the last point must still be
+    closer to the last forecast step than to the one after it, as in
+    best_departure_times (time_indices would clamp it to the last step).
+    dtime_last can also be an array, with the last point of many tracks.
+    """
+    dtime_radar = np.asarray(dtime_radar, dtype='timedelta64[ns]').astype(np.int64)
+    step = dtime_radar[1] - dtime_radar[0] if len(dtime_radar) > 1 else int(FORECAST_CYCLE.total_seconds() * 1e9)
+    dtime_last = np.asarray(dtime_last, dtype='timedelta64[ns]').astype(np.int64)
+
+    return np.maximum((dtime_radar[-1] + step // 2 - dtime_last) // step + 1, 0)
+
+def feasible_shifts(dtime_bike, dtime_radar):
+    """
+    All the shifts (in units of 5 minutes) for which the whole bike track
+    is still covered by the forecast, that is every possible departure time.
+    Empty if the track is longer than the forecast horizon.
+    """
+    dtime_bike = np.asarray(dtime_bike, dtype='timedelta64[ns]').astype(np.int64)
+
+    return np.arange(shift_horizon(dtime_bike.max(), dtime_radar))
+
+def grid_indices(lon_bike, lat_bike, shape):
+    """
+    Indices of the radar grid points (of the given shape) closest to the bike track,
+    computed directly with the RADOLAN projection: the forecast is always on the
+    RADOLAN grid, so its coordinates (lon_radar, lat_radar) are not needed.
+    """
+    return radar.get_radolan_rowcol(lon_bike, lat_bike, *shape)
+
+def compact_track(lon_bike, lat_bike, dtime_bike, lon_radar, lat_radar, dtime_radar, shape):
+    """
+    Collapse consecutive points of the track that fall in the same radar grid cell and
+    in the same forecast step into runs, represented by their first point: the forecast
+    is the same for all of them, whatever the departure time. A 1 Hz GPS track usually 
+    shrinks by an order of magnitude, as the radar resolution is 1 km and 5 minutes.
+    The last point of the track is always kept, so that the compacted track still ends
+    when the ride ends and every run lasts until the start of the next one.
+    Returns longitude, latitude and timedelta of the runs and the number of 
+    points in every run, see expand_track.
+    """
+    indx, indy = grid_indices(lon_bike, lat_bike, shape)
+    ind_time = time_indices(dtime_bike, dtime_radar)
+
+    new_run = np.ones(len(ind_time), dtype=bool)
+    new_run[1:] = (indx[1:] != indx[:-1]) | (indy[1:] != indy[:-1]) | (ind_time[1:] != ind_time[:-1])
+    new_run[-1] = True
+    starts = np.flatnonzero(new_run)
+    counts = np.diff(np.append(starts, len(ind_time)))
+
+    return lon_bike[starts], lat_bike[starts], dtime_bike[starts], counts
+
+def expand_track(rain_bike, counts):
+    """
+    Expand the forecast over a track compacted by compact_track 
+    back to every point of the original track.
+    """
+    return np.repeat(rain_bike, counts, axis=-1)
+
+def extract_rain_rate_from_radar(lon_bike, lat_bike, dtime_bike, lon_radar, lat_radar, dtime_radar, rr,
+                                 shifts=shifts):
+    """
+    Given the longitude, latitude and timedelta objects of the radar and of the bike 
+    find for every point of the bike track the closest point (in time/space) of the radar data. Then 
+    construct the rain_bike array by subsetting the rr array, that is the data from the radar,
+    and converting the values to mm/h with RAIN_RATE_LUT.
+    The closest points in space are found all at once, see grid_indices.
+    The indices are resolved only once for the track, then the values for all the
+    shifts (departure offsets, in units of 5 minutes) are gathered together. If shifts is
+    None every possible departure time is evaluated (see feasible_shifts).
+
+    Returns a numpy array (shifts x points) with the rain forecast over the bike track.
+    """
+    indx, indy = grid_indices(lon_bike, lat_bike, rr.shape[1:])
+    ind_time = time_indices(dtime_bike, dtime_radar)
+
+    shifts = check_shifts(shifts, dtime_bike, dtime_radar)
+
+    return RAIN_RATE_LUT[rr[ind_time + shifts[:, np.newaxis], indx, indy]]
+
+class InvalidShifts(ValueError):
+    """
+    The requested shifts are not valid or not covered by the forecast, see check_shifts.
+    """
+
+def check_shifts(shifts, dtime_bike, dtime_radar):
+    """
+    Make sure that the forecast covers the whole track for all the shifts
+    (see feasible_shifts), None stands for all the feasible ones.
+    """
+    feasible = feasible_shifts(dtime_bike, dtime_radar)
+    if not feasible.size:
+        raise InvalidShifts("No departure time within the forecast horizon covers the whole track")
+    if shifts is None:
+        shifts = feasible
+    shifts = np.asarray(shifts)
+    if shifts.size and (shifts.min() < 0 or shifts.max() >= feasible.size):
+        raise InvalidShifts("The forecast does not cover the whole track for shifts {}".format(shifts))
+
+    return shifts
+
+class SummedAreaTables(object):
+    """
+    Summed-area tables (integral images) of the rain rate of the steps of a radar cube,
+    so that the sum over any box of the grid costs 4 lookups. They're built the first time 
+    a step is needed and kept together with the cube (see get_summed_area_tables), so
+    that all the requests in the same forecast cycle share their cost. Every table takes 
+    8 bytes per grid point, that's why they're only built for the steps that are used.
+    """
+    def __init__(self, shape):
+        self.shape = shape
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def table(self, rr, step, threshold=None):
+        """
+        Table of the rain rate (mm/h) of step or, if threshold is given, of the
+        number of grid points with rain rate above threshold.
+        """
+        key = (step, threshold)
+        if key not in self._tables:
+            with self._lock:
+                if key not in self._tables:
+                    values = RAIN_RATE_LUT[rr[step]]
+                    if threshold is not None:
+                        values = values > threshold
+                    table = np.zeros((self.shape[0] + 1, self.shape[1] + 1),
+                                     dtype=np.float64 if threshold is None else np.int32)
+                    np.cumsum(np.cumsum(values, axis=0), axis=1, out=table[1:, 1:])
+                    self._tables[key] = table
+
+        return self._tables[key]
+
+    def box_sum(self, rr, step, row0, row1, col0, col1, threshold=None):
+        """
+        Sum over the boxes [row0:row1, col0:col1] of step, see table.
+        """
+        table = self.table(rr, step, threshold)
+
+        return table[row1, col1] - table[row0, col1] - table[row1, col0] + table[row0, col0]
+
+# The summed-area tables of the cubes in use, removed together with the cube
+_summed_area_tables = {}
+
+def get_summed_area_tables(rr):
+    """
+    Return the SummedAreaTables of the radar cube rr, creating them if needed.
+    """
+    key = id(rr)
+    if key not in _summed_area_tables:
+        _summed_area_tables[key] = SummedAreaTables(rr.shape[1:])
+        weakref.finalize(rr, _summed_area_tables.pop, key, None)
+
+    return _summed_area_tables[key]
+
+def extract_corridor_rain(lon_bike, lat_bike, dtime_bike, lon_radar, lat_radar, dtime_radar, rr,
+                          radius=1, stat='mean', threshold=0.1, shifts=shifts):
+    """
+    Same as extract_rain_rate_from_radar, but instead of the single closest grid point 
+    consider the box of (2*radius+1)x(2*radius+1) grid points (1 km each) around every point
+    of the track, which is much less noisy. stat can be
+        - mean: mean rain rate in the box (mm/h)
+        - coverage: fraction of the box with rain rate above threshold (mm/h)
+        - max: maximum rain rate in the box (mm/h)
+    The mean and coverage use the summed-area tables cached with the cube, so that every box
+    costs the same whatever the radius. The maximum cannot be computed from sums: it is 
+    computed directly on the box, which is fine for small radii.
+
+    Returns a numpy array (shifts x points) with the rain forecast over the bike track.
+    """
+    nrow, ncol = rr.shape[1:]
+    indx, indy = grid_indices(lon_bike, lat_bike, (nrow, ncol))
+    ind_time = time_indices(dtime_bike, dtime_radar)
+    shifts = check_shifts(shifts, dtime_bike, dtime_radar)
+    steps = ind_time + shifts[:, np.newaxis]
+
+    # boxes are cut at the borders of the grid
+    row0, row1 = np.maximum(indx - radius, 0), np.minimum(indx + radius + 1, nrow)
+    col0, col1 = np.maximum(indy - radius, 0), np.minimum(indy + radius + 1, ncol)
+
+    if stat == 'max':
+        import kernels
+        codes = kernels.box_max(rr, steps, row0, row1, col0, col1)
+        return RAIN_RATE_LUT[codes]
+    if stat not in ('mean', 'coverage'):
+        raise ValueError("Unknown statistic {}".format(stat))
+
+    tables = get_summed_area_tables(rr)
+    rain_bike = np.empty(steps.shape)
+    for step in np.unique(steps):
+        i, j = np.nonzero(steps == step)
+        rain_bike[i, j] = tables.box_sum(rr, step, row0[j], row1[j], col0[j], col1[j],
+                                         threshold=threshold if stat == 'coverage' else None)
+
+    return rain_bike / ((row1 - row0) * (col1 - col0))
+
+def pack_tracks(tracks):
+    """
+    Pack many tracks, given as (lon_bike, lat_bike, dtime_bike) tuples, in flat arrays
+    for extract_rain_rate_batch. Track k is in the slice offsets[k]:offsets[k+1].
+    Returns offsets, longitude, latitude and timedelta (as integer nanoseconds).
+    """
+    lengths = [len(track[0]) for track in tracks]
+    offsets = np.zeros(len(tracks) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    lon = np.concatenate([np.asarray(track[0], dtype=np.float64) for track in tracks])
+    lat = np.concatenate([np.asarray(track[1], dtype=np.float64) for track in tracks])
+    dtime = np.concatenate([np.asarray(track[2], dtype='timedelta64[ns]').astype(np.int64) 
+                            for track in tracks])
+
+    return offsets, lon, lat, dtime
+
+def extract_rain_rate_batch(offsets, lon_bike, lat_bike, dtime_bike, lon_radar, lat_radar, dtime_radar, rr,
+                            shifts=shifts):
+    """
+    Same as extract_rain_rate_from_radar but for many tracks at once, packed with pack_tracks,
+    against the same forecast. The indices of all the points are resolved together and then
+    the tracks are evaluated in parallel (one numba thread per core, set NUMBA_NUM_THREADS
+    to change it). Shifts that the forecast does not cover for a track give NaN.
+
+    Returns a numpy array (shifts x points), track k is in the columns offsets[k]:offsets[k+1].
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    indx, indy = grid_indices(lon_bike, lat_bike, rr.shape[1:])
+    # the points are independent, so the time indices of all the tracks are found together
+    ind_time = time_indices(dtime_bike, np.asarray(dtime_radar, dtype='timedelta64[ns]').astype(np.int64))
+
+    # and so is the number of shifts covering every track (see feasible_shifts),
+    # from its last point: the empty tracks have no points to reduce
+    nonempty = np.diff(offsets) > 0
+    dtime_last = np.zeros(len(offsets) - 1, dtype=np.int64)
+    if nonempty.any():
+        dtime_last[nonempty] = np.maximum.reduceat(dtime_bike, offsets[:-1][nonempty])
+    horizons = shift_horizon(dtime_last, dtime_radar).astype(np.int64)
+
+    import kernels
+    return kernels.extract_rain_rate_batch(offsets, indx, indy, ind_time, rr,
+                                           np.asarray(shifts, dtype=np.int64), horizons)
+
+def convert_to_dataframe(rain_bike, dtime_bike, time_radar, shifts=shifts):
     """
     Convert the forecast in a well-formatted dataframe which can then be plotted or converted 
-    to another format.
+    to another format. The shifts need to be the ones used in extract_rain_rate_from_radar,
+    None for every possible departure time.
     """
+    if shifts is None:
+        shifts = np.arange(rain_bike.shape[0])
     df = pd.DataFrame(data=rain_bike.T, index=dtime_bike, columns=time_radar[np.array(shifts)]) 
 
     return df 
 
+def total_rain(df):
+    """
+    Total rain (mm) over the track for every departure of the dataframe of
+    convert_to_dataframe. Every point counts for the time until the next one,
+    as the points of the compacted track (see compact_track) are not evenly spaced.
+    """
+    dtime_bike = df.index.values.astype('timedelta64[ns]').astype(np.int64)
+    # How long (hours) we stay on every point, the last one closes the track
+    hours = np.append(np.diff(dtime_bike), 0) / 3600e9
+
+    return hours.dot(df.values)
+
+def forecast_to_columns(df):
+    """
+    Columnar version of the dataframe of convert_to_dataframe, which can be
+    serialized as json: the offsets from the start of the track (seconds),
+    the departure times (ISO 8601, local time of Berlin as in the dataframe)
+    and, for every departure, the rain rate along the track (mm/h, rounded to 0.001).
+    """
+    return {'dtime': df.index.values.astype('timedelta64[s]').astype(np.int64).tolist(),
+            'departures': [departure.isoformat() for departure in df.columns],
+            'rain': np.round(df.values.T, 3).tolist()}
+
+def pack_forecast(df):
+    """
+    Binary version of the dataframe of convert_to_dataframe, all little endian:
+    the number of points and of departures (2 uint32), the offsets from the
+    start of the track (int32 seconds for every point), the departure times
+    (int64 seconds since 1970-01-01 for every departure, local time of Berlin
+    as in the dataframe) and the rain rate along the track (float32 mm/h,
+    one row of points for every departure).
+    """
+    departures = pd.DatetimeIndex(df.columns).values
+
+    return b''.join((np.array(df.shape, dtype='<u4').tobytes(),
+                     df.index.values.astype('timedelta64[s]').astype('<i4').tobytes(),
+                     departures.astype('datetime64[s]').astype('<i8').tobytes(),
+                     np.ascontiguousarray(df.values.T, dtype='<f4').tobytes()))
+
+def best_departure_times(lon_bike, lat_bike, dtime_bike, lon_radar, lat_radar, time_radar, dtime_radar, rr,
+                         metric='total', freq='1min', earliest=None, threshold=0.1, n=5):
+    """
+    Find the best times to leave within the forecast horizon, every freq (also less than
+    the 5 minutes of the forecast). For every departure time the ride is scored with
+        - total: total rain over the track (mm)
+        - peak: maximum rain rate over the track (mm/h)
+        - wet: minutes of the ride with rain rate above threshold (mm/h)
+    Since the track and the radar steps are both ordered in time, for every departure the
+    points falling in each radar step are a contiguous range of the track: with prefix sums
+    (range-maximum tables for the peak) over the rain at every step for every point, each 
+    departure is scored with a few lookups per radar step, whatever the length of the track.
+    Departures before earliest (a timestamp, same timezone as time_radar) are not considered.
+
+    Returns a dataframe with the n best departure times ranked according to metric.
+    """
+    if metric not in ('total', 'peak', 'wet'):
+        raise ValueError("Unknown metric {}".format(metric))
+
+    dtime_bike = np.asarray(dtime_bike, dtype='timedelta64[ns]').astype(np.int64)
+    dtime_radar = np.asarray(dtime_radar, dtype='timedelta64[ns]').astype(np.int64)
+    nsteps, npoints = len(dtime_radar), len(dtime_bike)
+
+    # Rain at every radar step for every point of the track
+    rain = extract_rain_rate_from_radar(lon_bike, lat_bike, np.zeros_like(dtime_bike),
+                                        lon_radar, lat_radar, dtime_radar, rr,
+                                        shifts=np.arange(nsteps))
+    # How long (hours) we stay on every point, the last one closes the track
+    hours = np.append(np.diff(dtime_bike), 0) / 3600e9
+    zero = np.zeros((nsteps, 1))
+    total_sums = np.hstack([zero, np.cumsum(rain * hours, axis=1)])
+    wet_sums = np.hstack([zero, np.cumsum((rain > threshold) * hours * 60., axis=1)])
+    peak_table = _range_max_table(rain)
+
+    # Candidate departures (offsets from the first forecast step), only the
+    # ones for which the forecast covers the whole ride
+    step = pd.to_timedelta(freq).value
+    first = 0
+    if earliest is not None:
+        first = max(0, -(-(pd.Timestamp(earliest) - time_radar[0]).value // step))
+    last = (dtime_radar[-1] + (dtime_radar[-1] - dtime_radar[-2]) // 2) - dtime_bike[-1]
+    offsets = np.arange(first, last // step + 1) * step
+    if not offsets.size:
+        raise ValueError("No departure time within the forecast horizon covers the whole track")
+
+    # Points are in step s (the closest radar step in time) when their time is between
+    # two midpoints: find, for every departure, where the ranges of points start and end
+    midpoints = (dtime_radar[1:] + dtime_radar[:-1]) / 2.
+    ends = np.searchsorted(dtime_bike, midpoints[np.newaxis, :] - offsets[:, np.newaxis], side='right')
+    ends = np.hstack([ends, np.full((len(offsets), 1), npoints)])
+    starts = np.hstack([np.zeros((len(offsets), 1), dtype=ends.dtype), ends[:, :-1]])
+    steps = np.arange(nsteps)[np.newaxis, :]
+
+    scores = {'total': (total_sums[steps, ends] - total_sums[steps, starts]).sum(axis=1),
+              'peak': _range_max(peak_table, steps, starts, ends).max(axis=1),
+              'wet': (wet_sums[steps, ends] - wet_sums[steps, starts]).sum(axis=1)}
+    # rank by metric, ties are broken by the total and peak rain, then the earliest departure
+    best = np.lexsort((offsets, scores['peak'], scores['total'], scores[metric]))[:n]
+
+    df = pd.DataFrame(data={key: value[best] for key, value in scores.items()},
+                      index=time_radar[0] + pd.to_timedelta(offsets[best]),
+                      columns=['total', 'peak', 'wet'])
+    df.index.name = 'departure'
+
+    return df
+
+def _range_max_table(a):
+    """
+    Sparse table for range-maximum queries along the last axis of a: level k
+    contains the maximum of a[..., i:i+2**k] for every i.
+    """
+    table = [a]
+    while 2 ** len(table) <= a.shape[-1]:
+        half = 2 ** (len(table) - 1)
+        previous = table[-1]
+        table.append(np.maximum(previous[..., :-half], previous[..., half:]))
+    # pad all the levels to the same length so they can be stored in a single array
+    return np.stack([np.pad(level, [(0, 0)] * (a.ndim - 1) + [(0, a.shape[-1] - level.shape[-1])],
+                            mode='constant') for level in table])
+
+def _range_max(table, rows, starts, ends):
+    """
+    Maximum of the (non negative) values in [starts, ends) for every row of the
+    table built by _range_max_table, 0 for the empty ranges.
+    """
+    lengths = ends - starts
+    level = np.floor(np.log2(np.maximum(lengths, 1))).astype(np.int64)
+    last = np.maximum(ends - 2 ** level, 0)
+    peak = np.maximum(table[level, rows, np.minimum(starts, table.shape[-1] - 1)],
+                      table[level, rows, last])
+
+    return np.where(lengths > 0, peak, 0.)
+
 def create_dummy_dataframe():
     """
     Create a dummy dataframe useful for testing the app and the plot.
@@ -1,11 +1,94 @@
-from flask import Flask, send_file, request, render_template, Markup
-from werkzeug import secure_filename
+import io
+import gzip
+import json
+import hashlib
+import traceback
+from flask import Flask, send_file, request, render_template, Markup, jsonify
 import radar_forecast_bike
-import plot_bokeh
-import plot_matplotlib
+import utils
+from refresher import ForecastRefresher, ForecastUnavailable
+from cubestore import CubeStore
+from trackcache import TrackCache
+from routecache import RouteCache
+from resultcache import ResultCache
 
 server = Flask(__name__)
 
+# The forecast is downloaded and decoded in the background, requests
+# only read the currently published version (waiting for it, if needed,
+# while the track is being read). The decoded cube is shared
+# by all the workers through memory-mapped files.
+refresher = ForecastRefresher(radar_forecast_bike.data_path,
+                              store=CubeStore(radar_forecast_bike.data_path/'nmwr_cubes'))
+# Parsed tracks, so that the same file uploaded again is not parsed anymore
+track_cache = TrackCache(radar_forecast_bike.data_path/'nmwr_tracks')
+# Google maps itineraries, so that the same one is not requested at every call
+route_cache = RouteCache(radar_forecast_bike.data_path/'nmwr_routes.sqlite')
+# Results of the current forecast, as the same tracks are asked many times in a cycle
+result_cache = ResultCache()
+
+def warm_up():
+  """
+  Do once, before the workers are forked (see gunicorn_config.py), what every
+  worker would otherwise do on its first requests, so that they inherit it:
+  import the plotting modules, build the page shell and a first plot of both
+  (loading fonts, mathtext and bokeh models) and get the latest forecast in the
+  store. No route runs a numba kernel, so numba is not even imported. No thread
+  is started here (e.g. the refresher): threads do not survive the fork.
+  """
+  import plot_bokeh
+  import plot_matplotlib
+
+  df = utils.create_dummy_dataframe()
+  plot_bokeh.create_plot(df)
+  plot_matplotlib.make_plot(df, out_filename=io.BytesIO())
+  if refresher.store is not None:
+    try:
+      refresher.store.update()
+    except Exception:
+      # The workers will try again anyway
+      traceback.print_exc()
+
+def parse_shifts(value):
+  """
+  Departure offsets (in units of 5 minutes) requested by the client, as
+  a comma-separated list or 'all' for every possible one.
+  """
+  if not value:
+    return utils.shifts
+  if value == 'all':
+    return None
+  try:
+    return tuple(int(shift) for shift in value.split(','))
+  except ValueError:
+    raise utils.InvalidShifts("Invalid shifts {!r}".format(value))
+
+def read_upload():
+  """
+  The uploaded track as a file-like object and its name, which gives the
+  format. The upload is read directly from the request, nothing is written
+  in the working directory. Without an upload the example track is used.
+  """
+  f = request.files.get('file')
+  if f:
+    return f.stream, f.filename
+  return 'track_points.csv', 'track_points.csv'
+
+@server.errorhandler(ForecastUnavailable)
+def forecast_unavailable(error):
+  """
+  No forecast could be retrieved in time (e.g. the DWD server is down and
+  there is none in the store yet): the client should try again later.
+  """
+  return str(error), 503, {'Retry-After': str(refresher.retry_interval)}
+
+@server.errorhandler(utils.InvalidShifts)
+def invalid_shifts(error):
+  """
+  The shifts asked by the client can't be parsed or go beyond the forecast.
+  """
+  return str(error), 400
+
 @server.route('/')
 def home():
     return """
@@ -40,22 +123,22 @@ def home():
 @server.route('/make_plot', methods = ['GET', 'POST'])
 def make_plot():
   if request.method == 'POST':
-    if request.files['file']:
-      f = request.files['file']
-      track_filename = secure_filename(f.filename)
-      f.save(track_filename)
-    else:
-      track_filename = 'track_points.csv'
-
-    # obviously we should use a temporary file instead, otherwise multiple
-    # parallel requests will overwrite the file from eachother...
-    plot_filename = 'plot_example.png'
+    track_file, track_filename = read_upload()
 
-    df = radar_forecast_bike.main(track_file=track_filename)
+    df = radar_forecast_bike.main(track_file=track_file, track_filename=track_filename,
+                                  forecast=refresher.current,
+                                  track_cache=track_cache, result_cache=result_cache,
+                                  shifts=parse_shifts(request.values.get('shifts')))
 
-    fig = plot_matplotlib.make_plot(df, out_filename=plot_filename)
+    # The plotting modules are slow to import and every route needs only one
+    # of them: they're imported when needed, or before the fork by warm_up
+    import plot_matplotlib
+    # Every request renders its own plot in memory
+    plot = io.BytesIO()
+    plot_matplotlib.make_plot(df, out_filename=plot)
+    plot.seek(0)
 
-    return send_file(plot_filename)
+    return send_file(plot, mimetype='image/png')
 
 @server.route('/make_plot_gmaps', methods = ['GET', 'POST'])
 def make_plot_gmaps():
@@ -65,24 +148,89 @@ def make_plot_gmaps():
       end_point = request.form.get("end_point")
       mode = request.form.get("selectMean")
 
-      df = radar_forecast_bike.main(start_point=start_point, end_point=end_point, mode=mode)
+      df = radar_forecast_bike.main(start_point=start_point, end_point=end_point, mode=mode,
+                                    forecast=refresher.current,
+                                    route_cache=route_cache, result_cache=result_cache,
+                                    shifts=parse_shifts(request.values.get('shifts')))
 
+      import plot_bokeh
       return plot_bokeh.create_plot(df)
 
 @server.route('/make_plot_file', methods = ['GET', 'POST'])
 def make_plot_file():
   if request.method == 'POST':
-    if request.files['file']:
-      f = request.files['file']
-      track_filename = secure_filename(f.filename)
-      f.save(track_filename)
-    else:
-      track_filename = 'track_points.csv'
+    track_file, track_filename = read_upload()
 
-    df = radar_forecast_bike.main(track_file=track_filename)
+    df = radar_forecast_bike.main(track_file=track_file, track_filename=track_filename,
+                                  forecast=refresher.current,
+                                  track_cache=track_cache, result_cache=result_cache,
+                                  shifts=parse_shifts(request.values.get('shifts')))
 
+    import plot_bokeh
     return plot_bokeh.create_plot(df)
         
+@server.route('/forecast', methods = ['GET', 'POST'])
+def forecast():
+  """
+  Rain along the track for every departure, without any plot: columnar json
+  (see utils.forecast_to_columns) or, with format=f32 or when asking for
+  application/octet-stream, packed float32 (see utils.pack_forecast).
+  The track is an uploaded file or the start_point/end_point/mode itinerary.
+  The ETag only depends on the forecast basetime, the track and the options,
+  so that clients polling get a 304 until a new forecast is published.
+  """
+  fmt = request.values.get('format')
+  if fmt is None:
+    fmt = 'f32' if request.accept_mimetypes.best_match(['application/json',
+                   'application/octet-stream']) == 'application/octet-stream' else 'json'
+  shifts = parse_shifts(request.values.get('shifts'))
+  current = refresher.current()
+
+  start_point, end_point = request.values.get('start_point'), request.values.get('end_point')
+  mode = request.values.get('mode', 'bicycling')
+  if start_point and end_point:
+    track_file = track_filename = track_key = None
+    track = route_cache.key(start_point, end_point, mode)
+  else:
+    track_file, track_filename = read_upload()
+    # The upload is hashed only here, main reuses the key
+    track = track_key = track_cache.key(track_file, track_filename)
+
+  etag = hashlib.sha1('{}|{}|{}|{}'.format(current.time_radar[0].isoformat(), track,
+                                           shifts, fmt).encode()).hexdigest()
+  if request.if_none_match.contains_weak(etag):
+    response = server.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+  df = radar_forecast_bike.main(track_file=track_file, track_filename=track_filename,
+                                start_point=start_point, end_point=end_point, mode=mode,
+                                forecast=current, track_cache=track_cache,
+                                route_cache=route_cache, result_cache=result_cache,
+                                track_key=track_key, shifts=shifts)
+  if fmt == 'f32':
+    body, mimetype = utils.pack_forecast(df), 'application/octet-stream'
+  else:
+    body = json.dumps(utils.forecast_to_columns(df), separators=(',', ':')).encode()
+    mimetype = 'application/json'
+
+  response = server.response_class(mimetype=mimetype)
+  if request.accept_encodings['gzip']:
+    body = gzip.compress(body)
+    response.headers['Content-Encoding'] = 'gzip'
+  response.set_data(body)
+  response.vary.add('Accept-Encoding')
+  response.set_etag(etag, weak=True)
+
+  return response
+
+@server.route('/stats')
+def stats():
+  """
+  Counters of the result cache of this worker, to tune its size.
+  """
+  return jsonify(result_cache.stats())
+
 if __name__ == '__main__':
   server.run(debug=True, use_reloader=True)
 